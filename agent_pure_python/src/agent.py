@@ -1,28 +1,53 @@
 """ Agent module to run a conversational agent in pure Python"""
 
+import contextvars
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
+import tracing
 from dotenv import load_dotenv
+from history import ConversationHistory, count_tokens
+from llm_cache import get_llm_cache
 from openai import OpenAI
+from python_code import execute_python_code
 from search import get_text_from_url, google_search
 
 _ = load_dotenv()
 
 client = OpenAI()
+# LLM calls are recorded or replayed depending on LLM_CACHE_MODE
+llm_cache = get_llm_cache()
+
+# Stream completions and start each action as soon as the model has written it
+STREAM_COMPLETIONS = os.getenv("AGENT_STREAM", "1") == "1"
+# The model must stop after an action, so generation is cut at PAUSE
+STOP_SEQUENCES = ["PAUSE", "\nObservation:"]
 
 # Add known actions
 known_actions = {
     "google_search": google_search,
     "download_webpage": get_text_from_url,
+    "execute_python_code": execute_python_code,
 }
 
+# Actions requested in one turn run concurrently on this pool
+tool_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("AGENT_TOOL_WORKERS", "8"))
+)
+# Seconds an action may run, not counting the time it waits for a worker
+ACTION_TIMEOUT = float(os.getenv("AGENT_ACTION_TIMEOUT", "60"))
+
 # Agent prompt
 prompt = """
 You run in a loop of Thought, Action, PAUSE, Observation.
 At the end of the loop you output an Answer
 Use Thought to describe your thoughts about the question you have been asked.
 Use Action to run one of the actions available to you - then return PAUSE.
-Observation will be the result of running those actions.
+If you need several independent actions, write one Action line for each before PAUSE.
+Observation will be the result of running those actions, labelled with the action when there are several.
 
 Your available actions are:
 
@@ -34,6 +59,10 @@ download_webpage:
 e.g. download_webpage: https://epoch.ai/data/notable-ai-models
 Returns the text content of the webpage
 
+execute_python_code:
+e.g. execute_python_code: revenues = [1.2, 0.9, 0.8]; sum(revenues)
+Runs python code written on one line and returns what it prints and the value of its last expression
+
 Example session:
 
 Question: Find all UK companies that have a revenue over 1 billion pounds in 2023?
@@ -53,7 +82,7 @@ Action: download_webpage: https://en.wikipedia.org/wiki/List_of_largest_companie
 PAUSE
 
 You will be called again with this:
-Observation: '\n\n\n\nList of largest companies in the United Kingdom - Wikipedia\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nJump to content\n\n\n\n\n\n\n\nMain menu\n\n\n\n\n\nMain menu\nmove to sidebar\nhide\n\n\n\n\t\tNavigation\n\t\n\n\nMain pageContentsCurrent eventsRandom articleAbout WikipediaContact us\n\n\n\n\n\n\t\tContribute\n\t\n\n\nHelpLearn to editCommunity portalRecent changesUpload file\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nSearch\n\n\n\n\n\n\n\n\n\n\n\nSearch\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nAppearance\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nDonate\n\nCreate account\n\nLog in\n\n\n\n\n\n\n\n\nPersonal tools\n\n\n\n\n\nDonate Create account Log in\n\n\n\n\n\n\t\tPages for logged out editors learn more\n\n\n\nContributionsTalk\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nContents\nmove to sidebar\nhide\n\n\n\n\n(Top)\n\n\n\n\n\n1\n2024 Fortune 500:\n\n\n\n\n\n\n\n\n2\n2024 Forbes list\n\n\n\n\n\n\n\n\n3\nSee also\n\n\n\n\n\n\n\n\n4\nReferences\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nToggle the table of contents\n\n\n\n\n\n\n\nList of largest companies in the United Kingdom\n\n\n\n3 languages\n\n\n\n\nالعربيةDeutschPortuguês\n\nEdit links\n\n\n\n\n\n\n\n\n\n\n\nArticleTalk\n\n\n\n\n\nEnglish\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nReadEditView history\n\n\n\n\n\n\n\nTools\n\n\n\n\n\nTools\nmove to sidebar\nhide\n\n\n\n\t\tActions\n\t\n\n\nReadEditView history\n\n\n\n\n\n\t\tGeneral\n\t\n\n\nWhat links hereRelated changesUpload fileSpecial pagesPermanent linkPage informationCite this pageGet shortened URLDownload QR code\n\n\n\n\n\n\t\tPrint/export\n\t\n\n\nDownload as PDFPrintable version\n\n\n\n\n\n\t\tIn other projects\n\t\n\n\nWikidata item\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nAppearance\nmove to sidebar\nhide\n\n\n\n\n\n\n\n\n\n\nFrom Wikipedia, the free encyclopedia\n\n\n\nThis article lists the largest companies in the United Kingdom in terms of their revenue, net profit and total assets, according to the American business magazines Fortune and Forbes.\n\n\n2024 Fortune 500:[edit]\nThis list displays all British companies in the Fortune Global 500, which ranks the world\'s largest companies by annual revenue. The figures below are given in millions of US dollars and are for the fiscal year 2023/24. Also listed are the headquarters location, net profit, number of employees worldwide and industry sector of each company.[1]\n\n\n\nRank\n\nFortune 500rank\n\nName\n\nIndustry\n\nRevenue(USD millions)\n\nProfits(USD millions)\n\nAssets(USD millions)\n\nEmployees\n\nHeadquarters\n\n\n 1\n\n 13\n\nShell plc\n\nOil and Gas\n\n 323,183\n\n 19,359\n\n406,270\n\n103,000\n\nLondon\n\n\n 2\n\n 25\n\nBP\n\nOil and Gas\n\n 213,032\n\n 15,239\n\n280,294\n\n79,400\n\nLondon\n\n\n 3\n\n 67\n\nHSBC\n\nBanking\n\n 134,901\n\n 23,533\n\n3,038,677\n\n220,861\n\nLondon\n\n\n 4\n\n 140\n\n\nSee also[edit]\nList of companies of the United Kingdom\nList of largest private companies in the United Kingdom\nList of largest companies by revenue\nList of largest private non-governmental companies by revenue\nReferences[edit]\n\n\n^ "Global 500". Fortune. Retrieved 2022-08-28.\n\n^ Murphy, Andrea; Contreras, Isabel. "The Global 2000". Forbes. Retrieved 2022-08-28.\n\n\n\n\n\n\nRetrieved from "https://en.wikipedia.org/w/index.php?title=List_of_largest_companies_in_the_United_Kingdom&oldid=1270056181"\nCategories: Lists of largest private companies by countryEconomy of the United Kingdom-related listsWealth in the United KingdomLists of companies of the United KingdomUnited Kingdom-related lists of superlativesHidden categories: Articles with short descriptionShort description is different from Wikidata\n\n\n\n\n\n\n This page was last edited on 17 January 2025, at 18:22\xa0(UTC).\nText is available under the Creative Commons Attribution-ShareAlike 4.0 License;\nadditional terms may apply. By using this site, you agree to the Terms of Use and Privacy Policy. Wikipedia® is a registered trademark of the Wikimedia Foundation, Inc., a non-profit organization.\n\n\nPrivacy policy\nAbout Wikipedia\nDisclaimers\nContact Wikipedia\nCode of Conduct\nDevelopers\nStatistics\nCookie statement\nMobile view\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nSearch\n\n\n\n\n\n\n\n\n\n\n\n\n\nSearch\n\n\n\n\n\n\n\n\n\nToggle the table of contents\n\n\n\n\n\n\n\nList of largest companies in the United Kingdom\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n3 languages\n\n\nAdd topic\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n'
+Observation: List of largest companies in the United Kingdom\nThis article lists the largest companies in the United Kingdom in terms of their revenue, net profit and total assets, according to the American business magazines Fortune and Forbes.\n2024 Fortune 500:\nThis list displays all British companies in the Fortune Global 500, which ranks the world\'s largest companies by annual revenue. The figures below are given in millions of US dollars and are for the fiscal year 2023/24. Also listed are the headquarters location, net profit, number of employees worldwide and industry sector of each company.[1]\nRank Fortune 500rank Name Industry Revenue(USD millions) Profits(USD millions) Assets(USD millions) Employees Headquarters\n1 13 Shell plc Oil and Gas 323,183 19,359 406,270 103,000 London\n2 25 BP Oil and Gas 213,032 15,239 280,294 79,400 London\n3 67 HSBC Banking 134,901 23,533 3,038,677 220,861 London\nSee also\nList of companies of the United Kingdom\nList of largest private companies in the United Kingdom\nList of largest companies by revenue\nReferences\n^ "Global 500". Fortune. Retrieved 2022-08-28.\n^ Murphy, Andrea; Contreras, Isabel. "The Global 2000". Forbes. Retrieved 2022-08-28.
 You then output:
 
 Thought: Largest companies listed are Shell plc, BP, HSBC. I should search for the revenue of these companies. I will start with Shell plc.
@@ -95,23 +124,100 @@ Answer: Shell plc is the only UK company with a revenue over 1 billion pounds in
 
 # Define simple Agent class
 class Agent:
-    def __init__(self, system=""):
+    def __init__(self, system="", history=None, stream=STREAM_COMPLETIONS):
         self.system = system
+        self.stream = stream
         self.messages = []
         if self.system:
             self.messages.append({"role": "system", "content": system})
+        # Only the messages selected by the history manager are sent to the model
+        self.history = history or ConversationHistory()
+        # Prompt tokens of each turn: the full history and what was actually sent
+        self.turn_tokens = []
 
-    def __call__(self, message):
+    def __call__(self, message, on_action=None):
         self.messages.append({"role": "user", "content": message})
-        result = self.execute()
+        result = self.execute(on_action)
         self.messages.append({"role": "assistant", "content": result})
         return result
 
-    def execute(self):
-        completion = client.chat.completions.create(
-            model="gpt-4o", temperature=0, messages=self.messages
+    def execute(self, on_action=None):
+        messages = self.history.build(self.messages)
+        request = {"model": "gpt-4o", "temperature": 0, "messages": messages}
+        if self.stream:
+            request["stop"] = STOP_SEQUENCES
+        with tracing.span("llm.chat", "llm", model=request["model"]) as span:
+            cached = llm_cache.get(request) if llm_cache else None
+            if cached is not None:
+                result, usage = cached, None
+                if self.stream:
+                    print(result)
+                    for line in result.split("\n"):
+                        self._dispatch(line, on_action)
+            elif self.stream:
+                result, usage = self.execute_stream(request, on_action)
+            else:
+                completion = client.chat.completions.create(**request)
+                result, usage = completion.choices[0].message.content, completion.usage
+            if cached is None and llm_cache:
+                llm_cache.set(request, result)
+            self.turn_tokens.append(
+                {
+                    "full": count_tokens(self.messages),
+                    "sent": count_tokens(messages),
+                    "usage": usage.prompt_tokens if usage else None,
+                }
+            )
+            span.set(
+                cached=cached is not None,
+                messages=len(messages),
+                prompt_tokens=usage.prompt_tokens if usage else None,
+                completion_tokens=usage.completion_tokens if usage else None,
+                output_chars=len(result),
+            )
+        return result
+
+    def execute_stream(self, request, on_action=None):
+        """Stream the completion, printing it as it arrives.
+
+        on_action(action, action_input) is called as soon as each Action line is
+        complete, so tools can start while the model is still writing.
+        """
+        stream = client.chat.completions.create(
+            **request, stream=True, stream_options={"include_usage": True}
         )
-        return completion.choices[0].message.content
+        text = ""
+        line_start = 0
+        usage = None
+        has_action = False
+        try:
+            for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = chunk.choices[0].delta.content
+                print(delta, end="", flush=True)
+                text += delta
+                # Check every line completed by this chunk for an action
+                while (line_end := text.find("\n", line_start)) != -1:
+                    has_action |= self._dispatch(text[line_start:line_end], on_action)
+                    line_start = line_end + 1
+        finally:
+            stream.close()
+        print()
+        has_action |= self._dispatch(text[line_start:], on_action)
+        # The stop sequence is not part of the output; keep the protocol in the history
+        if has_action:
+            text = text.rstrip("\n") + "\nPAUSE"
+        return text, usage
+
+    @staticmethod
+    def _dispatch(line, on_action):
+        match = action_re.match(line)
+        if match and on_action:
+            on_action(*match.groups())
+        return bool(match)
 
 
 abot = Agent(prompt)
@@ -120,23 +226,88 @@ action_re = re.compile(
 )  # python regular expression to select action
 
 
-def process_task(question, max_turns=10):
-    i = 0
-    bot = Agent(prompt)
-    next_prompt = question
-    while i < max_turns:
-        i += 1
-        result = bot(next_prompt)
-        print(result)
-        actions = [action_re.match(a) for a in result.split("\n") if action_re.match(a)]
-        if actions:
-            # There is an action to run
-            action, action_input = actions[0].groups()
-            if action not in known_actions:
-                raise Exception("Unknown action: {}: {}".format(action, action_input))
-            print(" -- running {} {}".format(action, action_input))
-            observation = known_actions[action](action_input)
-            print("Observation:", observation)
-            next_prompt = "Observation: {}".format(observation)
+class RunningAction:
+    """An action submitted to tool_executor. Its timeout starts when a worker
+    starts running it, not when it is queued"""
+
+    def __init__(self, action, action_input):
+        self.action = action
+        self.action_input = action_input
+        self.started = None
+        self.started_event = threading.Event()
+        # Run in a copy of the context, so tool spans are children of this task
+        self.future = tool_executor.submit(contextvars.copy_context().run, self._run)
+
+    def _run(self):
+        self.started = time.monotonic()
+        self.started_event.set()
+        return known_actions[self.action](self.action_input)
+
+    def wait(self, timeout):
+        """Wait until the action is done or has run for timeout seconds"""
+        self.started_event.wait()
+        remaining = self.started + timeout - time.monotonic()
+        wait([self.future], timeout=max(remaining, 0))
+        return self.future.done()
+
+
+def collect_observations(running, timeout=ACTION_TIMEOUT):
+    """Wait for the running actions and combine their results in one observation.
+
+    running holds RunningAction objects, or (action, action_input, observation)
+    tuples for the actions that could not be started"""
+    observations = []
+    for item in running:
+        if not isinstance(item, RunningAction):
+            observations.append(item)
+            continue
+        if not item.wait(timeout):
+            # A running thread cannot be stopped; its result is ignored
+            observation = f"Timed out after {timeout} seconds"
+        elif item.future.exception() is not None:
+            observation = f"Error: {item.future.exception()}"
         else:
-            return result
+            observation = item.future.result()
+        observations.append((item.action, item.action_input, observation))
+    if len(observations) == 1:
+        return "Observation: {}".format(observations[0][2])
+    return "Observation:\n" + "\n\n".join(
+        "[{}] {}: {}\n{}".format(n, action, action_input, observation)
+        for n, (action, action_input, observation) in enumerate(observations, start=1)
+    )
+
+
+def process_task(question, max_turns=10):
+    with tracing.span("agent.task", "agent", input_chars=len(question)) as span:
+        i = 0
+        bot = Agent(prompt)
+        next_prompt = question
+        while i < max_turns:
+            i += 1
+            span.set(turns=i)
+            running = []
+
+            def run_action(action, action_input):
+                if action not in known_actions:
+                    # Reported to the model, like a failed action
+                    error = "Error: Unknown action: {}".format(action)
+                    running.append((action, action_input, error))
+                    return
+                print(" -- running {} {}".format(action, action_input))
+                running.append(RunningAction(action, action_input))
+
+            result = bot(next_prompt, on_action=run_action)
+            if not bot.stream:
+                print(result)
+                for line in result.split("\n"):
+                    if match := action_re.match(line):
+                        run_action(*match.groups())
+            tokens = bot.turn_tokens[-1]
+            print(" -- prompt tokens: {sent} sent of {full}".format(**tokens))
+            if running:
+                # There are actions to run
+                observation = collect_observations(running)
+                print(observation)
+                next_prompt = observation
+            else:
+                return result
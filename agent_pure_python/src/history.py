@@ -0,0 +1,145 @@
+# This file contains the conversation history manager of the agent.
+# It decides which messages are sent to the model so the prompt stays within a token budget.
+
+import hashlib
+import os
+import threading
+import warnings
+from collections import OrderedDict
+
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "16000"))
+HISTORY_KEEP_RECENT = int(os.getenv("HISTORY_KEEP_RECENT", "4"))
+# Characters always kept from the question, even over the budget
+HISTORY_MIN_QUESTION_CHARS = int(os.getenv("HISTORY_MIN_QUESTION_CHARS", "500"))
+# Number of characters kept from an old observation
+OBSERVATION_HEAD_CHARS = int(os.getenv("OBSERVATION_HEAD_CHARS", "500"))
+# Approximate tokens added by the chat format for every message
+TOKENS_PER_MESSAGE = 4
+# Number of token counts cached
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken missing, or its encoding file cannot be downloaded
+    _encoding = None
+
+
+# Keyed on a hash of the text, so the cache does not keep large observations alive
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def count_text_tokens(text):
+    key = hashlib.sha1(text.encode()).digest()
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    if _encoding is None:
+        count = len(text) // 4 + 1
+    else:
+        count = len(_encoding.encode(text, disallowed_special=()))
+    with _token_counts_lock:
+        _token_counts[key] = count
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return count
+
+
+def count_tokens(messages):
+    """Count the prompt tokens of a list of chat messages"""
+    return sum(
+        count_text_tokens(message["content"]) + TOKENS_PER_MESSAGE
+        for message in messages
+    )
+
+
+def truncate_message(message, head_chars):
+    """Shorten a message to its first head_chars characters"""
+    content = message["content"]
+    if len(content) <= head_chars:
+        return message
+    elided = len(content) - head_chars
+    return {
+        "role": message["role"],
+        "content": f"{content[:head_chars]}\n[... {elided} characters elided]",
+    }
+
+
+def elide_observation(message, head_chars):
+    """Shorten an old observation to its first head_chars characters"""
+    if not message["content"].startswith("Observation"):
+        return message
+    return truncate_message(message, head_chars)
+
+
+class ConversationHistory:
+    """Select the messages to send to the model within a token budget.
+
+    The system prompt, the question and the last keep_recent messages are always
+    sent verbatim. Older observations are shortened first, and if the prompt is
+    still over max_tokens the oldest turns are dropped. When the system prompt and
+    the question alone are over max_tokens, the question is truncated, but never
+    below min_question_chars; a warning is issued if the prompt is still too long.
+    """
+
+    def __init__(
+        self,
+        max_tokens=HISTORY_MAX_TOKENS,
+        keep_recent=HISTORY_KEEP_RECENT,
+        observation_head_chars=OBSERVATION_HEAD_CHARS,
+        min_question_chars=HISTORY_MIN_QUESTION_CHARS,
+    ):
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self.observation_head_chars = observation_head_chars
+        self.min_question_chars = min_question_chars
+
+    def build(self, messages):
+        if count_tokens(messages) <= self.max_tokens:
+            return list(messages)
+
+        # Keep the system prompt and the question
+        pinned = 2 if messages[0]["role"] == "system" else 1
+        head, rest = list(messages[:pinned]), messages[pinned:]
+        split = max(len(rest) - self.keep_recent, 0)
+        old = [elide_observation(m, self.observation_head_chars) for m in rest[:split]]
+        recent = rest[split:]
+
+        # Drop the oldest assistant/observation pairs until the prompt fits
+        while old and count_tokens(head + old + recent) > self.max_tokens:
+            old = old[2:]
+        if count_tokens(head + recent) <= self.max_tokens:
+            return head + old + recent
+        question = not recent
+        if question:
+            # The system prompt and the question alone are too long: the question
+            # is the message to truncate
+            head, recent = head[:-1], head[-1:]
+
+        # The recent turns alone are too long: shorten all but the last observation,
+        # then truncate the last message to the tokens that are left
+        recent = [
+            elide_observation(m, self.observation_head_chars) for m in recent[:-1]
+        ] + recent[-1:]
+        # Leave a few tokens for the message overhead and the elision note
+        spare = self.max_tokens - count_tokens(head + recent[:-1]) - 16
+        last = recent[-1]
+        if count_text_tokens(last["content"]) > spare:
+            # Scale the characters kept by the characters per token of the message
+            chars = max(
+                len(last["content"]) * spare // count_text_tokens(last["content"]), 0
+            )
+            if question:
+                chars = max(chars, self.min_question_chars)
+            recent[-1] = truncate_message(last, chars)
+        tokens = count_tokens(head + recent)
+        if tokens > self.max_tokens:
+            warnings.warn(
+                f"Prompt of {tokens} tokens is over the budget of {self.max_tokens}:"
+                " the system prompt and the question do not fit"
+            )
+        return head + recent
@@ -0,0 +1,177 @@
+# This file contains the shared HTTP clients used by the search tools.
+# A single pooled requests.Session is shared by all threads, and one
+# httpx.AsyncClient is kept per event loop for the async tools.
+
+import asyncio
+import os
+import threading
+import weakref
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds to wait to connect and to read a response
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+# Maximum number of open connections to a single host
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "10"))
+# Maximum number of hosts to keep connection pools for
+MAX_HOSTS = int(os.getenv("HTTP_MAX_HOSTS", "50"))
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Other methods (the Serper POSTs, billed per request) may already have been
+# served, so they are only retried on connect errors and 429
+IDEMPOTENT_METHODS = Retry.DEFAULT_ALLOWED_METHODS
+USER_AGENT = "Mozilla/5.0 (compatible; small-agent/0.1)"
+
+_session = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+_host_semaphores = weakref.WeakKeyDictionary()
+
+
+class _Retry(Retry):
+    """Retry that also retries non-idempotent methods on 429 only"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() not in IDEMPOTENT_METHODS:
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def _is_retryable(method, status_code):
+    if method.upper() not in IDEMPOTENT_METHODS:
+        return status_code == 429
+    return status_code in RETRY_STATUSES
+
+
+def get_session():
+    """Return the shared requests session, creating it on first use"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # Connect errors are retried for every method, read errors
+                # and the other statuses only for IDEMPOTENT_METHODS
+                retry = _Retry(
+                    total=MAX_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=RETRY_STATUSES,
+                    allowed_methods=IDEMPOTENT_METHODS,
+                    respect_retry_after_header=True,
+                )
+                # pool_maxsize is per host; pool_block caps the connections to it
+                adapter = HTTPAdapter(
+                    pool_connections=MAX_HOSTS,
+                    pool_maxsize=MAX_CONNECTIONS_PER_HOST,
+                    pool_block=True,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.headers["User-Agent"] = USER_AGENT
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def request(method, url, **kwargs):
+    """Send a request through the shared session with the default timeouts"""
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().request(method, url, **kwargs)
+
+
+def fetch_text(url, max_bytes, content_types):
+    """Stream a text response, stopping after max_bytes.
+
+    Returns the content type and the decoded text, or None as text when the
+    content type does not start with any of content_types.
+    """
+    with request("GET", url, stream=True) as response:
+        content_type = response.headers.get("Content-Type", "").lower()
+        if content_type and not content_type.startswith(content_types):
+            return content_type, None
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            body += chunk
+            if len(body) >= max_bytes:
+                break
+        # Without a charset in the header, assume UTF-8 rather than Latin-1
+        encoding = response.encoding if "charset" in content_type else "utf-8"
+        return content_type, bytes(body[:max_bytes]).decode(encoding, errors="replace")
+
+
+def get_async_client():
+    """Return the httpx client of the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            headers={"User-Agent": USER_AGENT},
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=MAX_HOSTS * MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=MAX_HOSTS,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=MAX_RETRIES),
+            follow_redirects=True,
+        )
+        _async_clients[loop] = client
+        _host_semaphores[loop] = {}
+    return client
+
+
+def _host_semaphore(url):
+    """Return the semaphore limiting the concurrent requests to the host of url"""
+    semaphores = _host_semaphores[asyncio.get_running_loop()]
+    host = urlparse(url).netloc
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+    return semaphores[host]
+
+
+async def arequest(method, url, **kwargs):
+    """Async version of request. Limits the concurrent requests to each host
+    and retries responses with a retryable status code (only 429 for methods
+    that are not idempotent)."""
+    client = get_async_client()
+    async with _host_semaphore(url):
+        for attempt in range(MAX_RETRIES + 1):
+            response = await client.request(method, url, **kwargs)
+            if (
+                not _is_retryable(method, response.status_code)
+                or attempt == MAX_RETRIES
+            ):
+                return response
+            await asyncio.sleep(0.5 * 2**attempt)
+
+
+async def afetch_text(url, max_bytes, content_types):
+    """Async version of fetch_text"""
+    client = get_async_client()
+    async with _host_semaphore(url):
+        async with client.stream("GET", url) as response:
+            content_type = response.headers.get("Content-Type", "").lower()
+            if content_type and not content_type.startswith(content_types):
+                return content_type, None
+            body = bytearray()
+            async for chunk in response.aiter_bytes(chunk_size=64 * 1024):
+                body += chunk
+                if len(body) >= max_bytes:
+                    break
+            encoding = response.encoding if "charset" in content_type else "utf-8"
+            return content_type, bytes(body[:max_bytes]).decode(
+                encoding, errors="replace"
+            )
+
+
+async def aclose():
+    """Close the httpx client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.pop(loop, None)
+    _host_semaphores.pop(loop, None)
+    if client is not None:
+        await client.aclose()
@@ -1,27 +1,93 @@
 # File to process queries saved in tasks.txt file and write out the results.
+# Tasks are processed concurrently. Every finished task is appended to a journal
+# file straight away, so a crashed run can be resumed without redoing work.
 
+import argparse
+import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from agent import process_task
 
+MAX_WORKERS = int(os.getenv("AGENT_MAX_WORKERS", "8"))
 
-def process_queries(file_path):
+
+def read_journal(journal_path):
+    """Read finished tasks from the journal. Returns a dict of line index -> (task, result)"""
+    done = {}
+    if not os.path.exists(journal_path):
+        return done
+    with open(journal_path, "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be partially written if the run crashed
+                continue
+            done[record["index"]] = (record["task"], record["result"])
+    return done
+
+
+def run_task(task):
+    """Run a single task. Returns the result and whether the task succeeded"""
+    try:
+        return process_task(task), True
+    except Exception as e:
+        return f"Error: {e}", False
+
+
+def process_queries(
+    file_path,
+    output_path="results.txt",
+    journal_path=None,
+    max_workers=MAX_WORKERS,
+):
     with open(file_path, "r") as file:
-        tasks = file.readlines()
+        tasks = [task.strip() for task in file.readlines()]
+
+    journal_path = journal_path or output_path + ".journal"
+    done = read_journal(journal_path)
 
-    task_result_pairs = []
+    # Skip tasks that were already finished by a previous run
+    pending = [
+        (index, task)
+        for index, task in enumerate(tasks)
+        if task and done.get(index, (None,))[0] != task
+    ]
+    print(f"{len(tasks) - len(pending)} tasks already done, {len(pending)} to run")
 
-    for task in tasks:
-        result = process_task(task)
-        task_result_pairs.append((task.strip(), result))
+    with open(journal_path, "a") as journal, ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as executor:
+        futures = {
+            executor.submit(run_task, task): (index, task) for index, task in pending
+        }
+        for future in as_completed(futures):
+            index, task = futures[future]
+            result, ok = future.result()
+            # Stream the result to the journal as soon as it is ready.
+            # Failed tasks are not journaled, so they are retried on resume
+            if ok:
+                journal.write(
+                    json.dumps({"index": index, "task": task, "result": result}) + "\n"
+                )
+                journal.flush()
+            done[index] = (task, result)
+            print(f"Finished task {index + 1}/{len(tasks)}: {task}")
 
-    # Write the results to a file
-    with open("results.txt", "w") as file:
-        for task, result in task_result_pairs:
-            file.write(f"Task: {task} - Result: {result}\n")
+    # Write the results to a file, keeping the order of the input tasks
+    with open(output_path, "w") as file:
+        for index, task in enumerate(tasks):
+            if index in done:
+                file.write(f"Task: {task} - Result: {done[index][1]}\n")
 
 
 if __name__ == "__main__":
-    file_path = "tasks.txt"
-    process_queries(file_path)
+    parser = argparse.ArgumentParser(description="Process tasks with the agent")
+    parser.add_argument("file_path", nargs="?", default="tasks.txt")
+    parser.add_argument("--output", default="results.txt")
+    parser.add_argument("--journal", default=None)
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    args = parser.parse_args()
+    process_queries(args.file_path, args.output, args.journal, args.workers)
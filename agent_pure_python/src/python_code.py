@@ -1,22 +1,245 @@
 # This file contains functions to execute python code generated by LLM
+# Code runs in a pool of warm worker processes, each with CPU time and memory
+# limits, so a runaway snippet cannot stall or bloat the agent process.
 
+import ast
+import contextlib
+import hashlib
+import io
+import multiprocessing
 import os
+import queue
+import signal
 import sys
+import tempfile
+import threading
+import traceback
+from urllib.parse import urlparse
 
-import requests
+from http_client import request
+from tracing import traced
 
+try:
+    import resource
+except ImportError:  # Windows: snippets run without CPU and memory limits
+    resource = None
 
+CODE_WORKERS = int(os.getenv("CODE_WORKERS", "2"))
+CODE_CPU_SECONDS = int(os.getenv("CODE_CPU_SECONDS", "10"))
+CODE_MEMORY_MB = int(os.getenv("CODE_MEMORY_MB", "512"))
+CODE_WALL_SECONDS = float(os.getenv("CODE_WALL_SECONDS", "30"))
+# Modules imported once when a worker starts, instead of on every call
+CODE_PRELOAD = os.getenv(
+    "CODE_PRELOAD", "math,statistics,json,re,datetime,collections,pandas"
+).split(",")
+MAX_OUTPUT_CHARS = 10000
+# Downloaded CSV files are saved here, and read back in chunks of this many rows
+CSV_DOWNLOAD_DIR = os.getenv("CSV_DOWNLOAD_DIR", "downloads")
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "100000"))
+
+
+def run_snippet(code, namespace):
+    """Run code and return its stdout and the value of its last expression"""
+    tree = ast.parse(code)
+    last = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last = ast.Expression(tree.body.pop().value)
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        exec(compile(tree, "<agent>", "exec"), namespace)
+        value = eval(compile(last, "<agent>", "eval"), namespace) if last else None
+    return stdout.getvalue(), value
+
+
+def _address_space_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmSize:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _worker_main(conn, cpu_seconds, memory_mb):
+    """Worker loop: receive code, run it, send back (ok, stdout, value repr)"""
+    modules = {}
+    for name in CODE_PRELOAD:
+        with contextlib.suppress(ImportError):
+            modules[name] = __import__(name)
+    if "pandas" in modules:
+        modules["pd"] = modules["pandas"]
+    if resource is not None:
+        # Allow memory_mb on top of what the preloaded modules already use
+        with contextlib.suppress(OSError, ValueError):
+            limit = _address_space_bytes() + memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    while True:
+        try:
+            code = conn.recv()
+        except EOFError:
+            return
+        if resource is not None:
+            # RLIMIT_CPU counts the whole life of the process, so move it past the
+            # CPU time used so far. The process is killed when it is exceeded.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = int(usage.ru_utime + usage.ru_stime)
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds + 1, hard))
+        try:
+            stdout, value = run_snippet(code, {"__name__": "__agent__", **modules})
+            conn.send((True, stdout, None if value is None else repr(value)))
+        except MemoryError:
+            conn.send((False, "", f"MemoryError: over the {memory_mb} MB limit"))
+        except BaseException:
+            error = traceback.format_exc(limit=-1).strip().splitlines()[-1]
+            conn.send((False, "", error))
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class CodeWorker:
+    """A subprocess interpreter that runs snippets one at a time"""
+
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(self, cpu_seconds=CODE_CPU_SECONDS, memory_mb=CODE_MEMORY_MB):
+        self.cpu_seconds = cpu_seconds
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main,
+            args=(child_conn, cpu_seconds, memory_mb),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def run(self, code, timeout):
+        self.conn.send(code)
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"Code did not finish within {timeout} seconds")
+        try:
+            return self.conn.recv()
+        except EOFError:
+            self.process.join(1)
+            if self.process.exitcode == -getattr(signal, "SIGXCPU", 0):
+                raise WorkerDied(
+                    f"Code used more than {self.cpu_seconds} seconds of CPU time"
+                )
+            raise WorkerDied(f"Code crashed (exit code {self.process.exitcode})")
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """Pool of warm workers. Workers start on first use and a worker that hits a
+    limit is replaced straight away, so the next call finds a warm one."""
+
+    def __init__(self, size=CODE_WORKERS, timeout=CODE_WALL_SECONDS):
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.Queue()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if not self.started:
+                for _ in range(self.size):
+                    self.idle.put(CodeWorker())
+                self.started = True
+
+    def run(self, code):
+        """Run code in a worker. Returns (ok, stdout, value repr or error message)"""
+        self._start()
+        worker = self.idle.get()
+        try:
+            result = worker.run(code, self.timeout)
+        except (OSError, WorkerDied) as e:  # TimeoutError is an OSError
+            worker.kill()
+            worker = CodeWorker()
+            result = (False, "", str(e))
+        finally:
+            self.idle.put(worker)
+        return result
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().kill()
+        self.started = False
+
+
+pool = WorkerPool()
+
+
+@traced("tool.execute_python_code", "tool")
 def execute_python_code(code):
-    try:
-        exec(code)
-    except Exception as e:
-        return "There is an error in the code, try again: " + str(e)
+    ok, stdout, value = pool.run(code)
+    if not ok:
+        return "There is an error in the code, try again: " + value
+    output = stdout + (value or "")
+    if not output:
+        return "The code ran without output"
+    if len(output) > MAX_OUTPUT_CHARS:
+        output = output[:MAX_OUTPUT_CHARS] + "\n[truncated]"
+    return output
 
 
 # function to download a csv from a url and save it to a file
-def download_csv_from_url(url):
-    filename = "data.csv"
-    response = requests.get(url)
-    with open(filename, "wb") as f:
-        f.write(response.content)
-    return f"Downloaded file from {url} and saved it to {filename}"
+def download_csv_from_url(url, directory=CSV_DOWNLOAD_DIR, summarize=True):
+    """Stream a CSV file to disk in chunks, under a name unique to the URL.
+    Returns where it was saved and, if summarize is set, a summary of its contents."""
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(urlparse(url).path))[0] or "data"
+    url_hash = hashlib.sha1(url.encode()).hexdigest()[:8]
+    filename = os.path.join(directory, f"{stem}_{url_hash}.csv")
+    size = 0
+    with request("GET", url, stream=True) as response:
+        response.raise_for_status()
+        # Write to a temporary file so an interrupted download leaves no partial CSV.
+        # Its name is unique, so concurrent downloads of the same URL do not mix
+        with tempfile.NamedTemporaryFile(
+            dir=directory, prefix=f"{stem}_{url_hash}.", suffix=".part", delete=False
+        ) as f:
+            try:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+    os.replace(f.name, filename)
+    message = f"Downloaded file from {url} and saved it to {filename} ({size} bytes)"
+    if summarize:
+        try:
+            message += "\n" + summarize_csv(filename)
+        except Exception as e:  # not a CSV file, or a malformed one
+            message += f"\nCannot read it as a CSV file: {e}"
+    return message
+
+
+def iter_csv_chunks(filename, chunk_rows=CSV_CHUNK_ROWS):
+    """Read a CSV file as a sequence of pandas DataFrames of chunk_rows rows"""
+    import pandas as pd
+
+    return pd.read_csv(filename, chunksize=chunk_rows)
+
+
+def summarize_csv(filename, chunk_rows=CSV_CHUNK_ROWS):
+    """Describe a CSV file without loading it into memory at once"""
+    rows = 0
+    head = None
+    for chunk in iter_csv_chunks(filename, chunk_rows):
+        if head is None:
+            head = chunk.head()
+        rows += len(chunk)
+    if head is None:
+        return "The file is empty"
+    return (
+        f"{rows} rows, columns: {', '.join(map(str, head.columns))}\n"
+        f"First rows:\n{head.to_string()}"
+    )
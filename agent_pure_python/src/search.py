@@ -2,68 +2,208 @@
 
 import json
 import os
-from urllib.parse import urlparse
+import re
+from urllib.parse import urljoin, urlparse
 
-import requests
+import lxml.etree
+import lxml.html
 from bs4 import BeautifulSoup as bs
+from http_client import afetch_text, arequest, fetch_text, request
+from search_cache import SearchCache
+from tracing import span, traced
 
 SERPER_API_KEY = os.getenv("SERPER_API_KEY")
+SERPER_URL = os.getenv("SERPER_URL", "https://google.serper.dev/search")
+
+# Parsed search results are cached, so repeated queries do not hit the paid API.
+# The cache file (SEARCH_CACHE_PATH) is only created when it is first used
+search_cache = SearchCache()
+
+# Only this much of a webpage is downloaded and passed on to the agent
+MAX_PAGE_BYTES = int(os.getenv("MAX_PAGE_BYTES", str(2 * 1024 * 1024)))
+MAX_PAGE_CHARS = int(os.getenv("MAX_PAGE_CHARS", "20000"))
+TEXT_CONTENT_TYPES = ("text/", "application/xhtml", "application/xml")
+
+# Elements that never hold the main text of a page
+BOILERPLATE_TAGS = [
+    "script",
+    "style",
+    "noscript",
+    "template",
+    "svg",
+    "iframe",
+    "form",
+    "button",
+    "nav",
+    "header",
+    "footer",
+    "aside",
+]
+BOILERPLATE_XPATH = (
+    ".//*[@role='navigation' or @role='banner' or @role='contentinfo'"
+    " or @role='search' or @aria-hidden='true'"
+    " or contains(@class, 'navbox') or contains(@class, 'sidebar')"
+    " or contains(@class, 'mw-editsection') or contains(@class, 'cookie')"
+    " or @id='toc' or @id='mw-navigation' or @id='catlinks']"
+)
+MAIN_XPATH = "//main | //*[@role='main']"
+BLOCK_TAGS = (
+    "p div section article li ul ol table tr br h1 h2 h3 h4 h5 h6 "
+    "pre blockquote dd dt caption"
+).split()
+
+
+# Code to download a webpage and extract its text
+def download_webpage(url):
+    response = request("GET", url)
+    return response.text
 
 
-# Code to download a webpage and parse it using BeautifulSoup
-def download_webpage(url):
-    response = requests.get(url)
+async def adownload_webpage(url):
+    response = await arequest("GET", url)
     return response.text
 
 
+@traced("html.parse")
 def parse_webpage(html):
-    soup = bs(html, "html.parser")
-    return soup.get_text()
+    """Extract the readable text of a webpage, without scripts, styles and navigation"""
+    try:
+        text = _extract_text_lxml(html)
+    except (lxml.etree.ParserError, ValueError):
+        # Fall back to the slower, more forgiving BeautifulSoup parser
+        soup = bs(html, "html.parser")
+        for tag in soup(BOILERPLATE_TAGS):
+            tag.decompose()
+        text = soup.get_text("\n")
+    return collapse_whitespace(text)
+
+
+def _extract_text_lxml(html):
+    doc = lxml.html.document_fromstring(html)
+    # Keep the main content of the page if it is marked up
+    main = doc.xpath(MAIN_XPATH)
+    root = main[0] if main else doc
+    for element in root.xpath(BOILERPLATE_XPATH) + [
+        element for tag in BOILERPLATE_TAGS for element in root.iter(tag)
+    ]:
+        if element.getparent() is not None:
+            element.drop_tree()
+    # Separate block elements and table cells, which text_content() would glue together
+    for element in root.iter(*BLOCK_TAGS):
+        element.tail = "\n" + (element.tail or "")
+    for element in root.iter("td", "th"):
+        element.tail = " " + (element.tail or "")
+    return root.text_content()
+
+
+def collapse_whitespace(text):
+    """Collapse runs of spaces and drop blank lines"""
+    lines = (re.sub(r"\s+", " ", line).strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def page_to_text(url, content_type, html):
+    if html is None:
+        return f"Cannot read {url}: unsupported content type {content_type}"
+    text = parse_webpage(html)
+    if len(text) > MAX_PAGE_CHARS:
+        text = text[:MAX_PAGE_CHARS] + "\n[truncated]"
+    return text
 
 
 def get_csv_links_from_url(url):
-    html = download_webpage(url)
-    soup = bs(html, "html.parser")
-    resp = requests.get(url)
-    soup = bs(resp.text, "lxml")
-    og = soup.find("meta", property="og:url")
-    base = urlparse(url)
+    response = request("GET", url)
+    return find_csv_links(response.url, response.text)
+
+
+async def aget_csv_links_from_url(url):
+    response = await arequest("GET", url)
+    return find_csv_links(str(response.url), response.text)
+
+
+def find_csv_links(url, html):
+    """Return the absolute URLs of the CSV files linked from a page"""
+    if not html.strip():
+        return ["No CSV links found on the page"]
+    doc = lxml.html.document_fromstring(html)
+    # Relative links resolve against <base href>, or else the page URL
+    base = doc.xpath("//base/@href")
+    base_url = urljoin(url, base[0]) if base else url
     links = []
-    for link in soup.find_all("a"):
-        current_link = link.get("href")
-        if current_link.endswith("csv"):
-            if og:
-                links.append(og["content"] + current_link)
-            else:
-                links.append(base.scheme + "://" + base.netloc + current_link)
+    for href in doc.xpath("//a/@href"):
+        link = urljoin(base_url, href.strip())
+        parsed = urlparse(link)
+        if parsed.path.lower().endswith(".csv") or "format=csv" in parsed.query:
+            if link not in links:
+                links.append(link)
     if len(links) == 0:
         return ["No CSV links found on the page"]
 
     return links
 
 
+@traced("tool.download_webpage", "tool")
 def get_text_from_url(url):
-    html = download_webpage(url)
-    text = parse_webpage(html)
-    return text
+    with span("http.fetch", "http", url=url) as fetch_span:
+        content_type, html = fetch_text(url, MAX_PAGE_BYTES, TEXT_CONTENT_TYPES)
+        fetch_span.set(content_type=content_type, output_chars=len(html or ""))
+    return page_to_text(url, content_type, html)
+
+
+async def aget_text_from_url(url):
+    content_type, html = await afetch_text(url, MAX_PAGE_BYTES, TEXT_CONTENT_TYPES)
+    return page_to_text(url, content_type, html)
 
 
 # Code to search Google using the Serper API
+@traced("tool.google_search", "tool")
 def google_search(query):
-    url = "https://google.serper.dev/search"
+    cached = search_cache.get(query)
+    if cached is not None:
+        return cached
 
     payload = json.dumps({"q": query})
     headers = {"X-API-KEY": SERPER_API_KEY, "Content-Type": "application/json"}
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    with span("serper.search", "http") as search_span:
+        response = request("POST", SERPER_URL, headers=headers, data=payload)
+        search_span.set(status=response.status_code, output_chars=len(response.text))
+    # A failed request (429, 5xx) is reported to the agent, and not cached
+    response.raise_for_status()
 
     results = json.loads(response.text)
 
     output = parse_snippets(results)
+    cache_results(query, output)
 
     return output
 
 
+async def agoogle_search(query):
+    cached = search_cache.get(query)
+    if cached is not None:
+        return cached
+
+    payload = json.dumps({"q": query})
+    headers = {"X-API-KEY": SERPER_API_KEY, "Content-Type": "application/json"}
+
+    response = await arequest("POST", SERPER_URL, headers=headers, content=payload)
+    response.raise_for_status()
+
+    results = json.loads(response.text)
+
+    output = parse_snippets(results)
+    cache_results(query, output)
+
+    return output
+
+
+def cache_results(query, output):
+    # An empty result may be temporary, so only results with snippets are cached
+    if isinstance(output, dict):
+        search_cache.set(query, output)
+
+
 def parse_snippets(results: dict) -> dict:
     snippets = {}
 
@@ -0,0 +1,122 @@
+# This file contains a two tier cache for search results: an in-memory LRU
+# in front of an SQLite table on disk, both with a time to live.
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "search_cache.sqlite")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(24 * 60 * 60)))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+
+
+def normalize_query(query):
+    """Lowercase the query and collapse whitespace so trivial variations share a key"""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class SearchCache:
+    """Cache of search results keyed on the normalized query.
+
+    Entries older than ttl seconds are ignored. Set path to None to keep the
+    cache in memory only. The cache is safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path=SEARCH_CACHE_PATH,
+        ttl=SEARCH_CACHE_TTL,
+        max_entries=SEARCH_CACHE_SIZE,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # Opened on first use, so importing the search tools creates no file
+        self.conn = None
+
+    def _connection(self):
+        """Return the SQLite connection, opening it on first use. Call it with the
+        lock held"""
+        if self.conn is None and self.path:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache "
+                "(query TEXT PRIMARY KEY, created REAL, value TEXT)"
+            )
+            self.conn.commit()
+        return self.conn
+
+    def get(self, query):
+        """Return the cached value for the query, or None if missing or expired"""
+        key = normalize_query(query)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            conn = self._connection()
+            if conn is not None:
+                row = conn.execute(
+                    "SELECT created, value FROM search_cache WHERE query = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[0] < self.ttl:
+                    value = json.loads(row[1])
+                    self._remember(key, row[0], value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def set(self, query, value):
+        key = normalize_query(query)
+        created = time.time()
+        with self.lock:
+            self._remember(key, created, value)
+            conn = self._connection()
+            if conn is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?)",
+                    (key, created, json.dumps(value)),
+                )
+                conn.commit()
+
+    def _remember(self, key, created, value):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def purge_expired(self):
+        """Remove expired entries from both tiers"""
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            for key in [
+                k for k, (created, _) in self.memory.items() if created < cutoff
+            ]:
+                del self.memory[key]
+            conn = self._connection()
+            if conn is not None:
+                conn.execute("DELETE FROM search_cache WHERE created < ?", (cutoff,))
+                conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+        }
@@ -0,0 +1,366 @@
+""" Offline benchmarks of the three agents against local API stand-ins.
+
+Each agent runs a batch of tasks at several concurrency levels, with OpenAI and
+Serper served by a local stub server (stub_server.py) and Tavily replaced by an
+in-process fake. Every (agent, concurrency) run happens in its own process, so
+the peak memory is measured per run and the agents' modules do not clash.
+
+Reported per run: wall time, throughput, task and per-node latency percentiles,
+LLM and tool call counts, tokens and peak memory.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py --agents pure_python,research,essay --concurrency 1,4,16
+
+research_async runs the company research graph with its async nodes on one event loop.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import inspect
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, fields
+from pathlib import Path
+
+from stub_server import FakeAsyncTavilyClient, FakeTavilyClient, StubConfig, StubServer
+
+ROOT = Path(__file__).resolve().parent.parent
+AGENT_DIRS = {
+    "pure_python": ROOT / "agent_pure_python" / "src",
+    "research": ROOT / "company_research_tool" / "src",
+    "research_async": ROOT / "company_research_tool" / "src",
+    "essay": ROOT / "essay_writer_agent" / "src",
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+class NodeTimer:
+    """Collect durations per node name from several threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.durations[name].append(seconds)
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        return timed
+
+
+def stream_nodes(graph, graph_input, thread, timer):
+    """Run a LangGraph graph until it ends or is interrupted, timing every node"""
+    start = time.perf_counter()
+    for update in graph.stream(graph_input, thread, stream_mode="updates"):
+        now = time.perf_counter()
+        for node in update:
+            if not node.startswith("__"):
+                timer.record(node, now - start)
+        start = now
+
+
+async def astream_nodes(graph, graph_input, thread, timer):
+    """stream_nodes with the graph's async nodes"""
+    start = time.perf_counter()
+    async for update in graph.astream(graph_input, thread, stream_mode="updates"):
+        now = time.perf_counter()
+        for node in update:
+            if not node.startswith("__"):
+                timer.record(node, now - start)
+        start = now
+
+
+# Agent runners. Each returns a function, or a coroutine function, running one task.
+
+
+def pure_python_runner(config, timer):
+    import agent
+
+    agent.Agent.execute = timer.wrap("llm", agent.Agent.execute)
+    for name, action in list(agent.known_actions.items()):
+        agent.known_actions[name] = timer.wrap(f"tool:{name}", action)
+    return lambda i: agent.process_task(f"Find the revenue of company number {i}")
+
+
+def research_runner(config, timer):
+    import agent
+
+    researcher = agent.eresearcher()
+    researcher.tavily = FakeTavilyClient(config)
+
+    def run(i):
+        thread = {"configurable": {"thread_id": str(i)}}
+        stream_nodes(researcher.graph, {"task": f"Company {i} Ltd"}, thread, timer)
+
+    run.tavily = researcher.tavily
+    return run
+
+
+def research_async_runner(config, timer):
+    import agent
+
+    researcher = agent.eresearcher()
+    researcher.atavily = FakeAsyncTavilyClient(config)
+
+    async def run(i):
+        thread = {"configurable": {"thread_id": str(i)}}
+        await astream_nodes(
+            researcher.graph, {"task": f"Company {i} Ltd"}, thread, timer
+        )
+
+    run.tavily = researcher.atavily
+    return run
+
+
+def essay_runner(config, timer):
+    import agent
+
+    writer = agent.ewriter()
+    writer.tavily = FakeTavilyClient(config)
+
+    def run(i):
+        thread = {"configurable": {"thread_id": str(i)}}
+        graph_input = {
+            "task": f"Essay topic number {i}",
+            "max_revisions": 2,
+            "revision_number": 0,
+            "lnode": "",
+            "plan": "",
+            "draft": "",
+            "critique": "",
+            "content": [],
+            "queries": [],
+            "count": 0,
+        }
+        # The graph is interrupted after every node, as it is in the GUI
+        stream_nodes(writer.graph, graph_input, thread, timer)
+        while writer.graph.get_state(thread).next:
+            stream_nodes(writer.graph, None, thread, timer)
+
+    run.tavily = writer.tavily
+    return run
+
+
+RUNNERS = {
+    "pure_python": pure_python_runner,
+    "research": research_runner,
+    "research_async": research_async_runner,
+    "essay": essay_runner,
+}
+
+
+def server_call(url, path, method="GET"):
+    request = urllib.request.Request(
+        url + path, data=b"{}" if method == "POST" else None
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run_child(args):
+    """Run one agent at one concurrency level and write the results as JSON"""
+    config = StubConfig(**json.loads(args.config))
+    sys.path.insert(0, str(AGENT_DIRS[args.agent]))
+    timer = NodeTimer()
+    task_times = []
+    errors = []
+
+    def run_task(i):
+        start = time.perf_counter()
+        try:
+            run(i)
+        except Exception as e:
+            errors.append(repr(e))
+        task_times.append(time.perf_counter() - start)
+
+    async def arun_tasks():
+        # Async runners share one event loop, concurrency tasks at a time
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def arun_task(i):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await run(i)
+                except Exception as e:
+                    errors.append(repr(e))
+                task_times.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(arun_task(i) for i in range(args.tasks)))
+
+    # The agents print a lot; keep the benchmark output readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        run = RUNNERS[args.agent](config, timer)
+        server_call(args.server, "/__reset", "POST")
+        start = time.perf_counter()
+        if inspect.iscoroutinefunction(run):
+            asyncio.run(arun_tasks())
+        else:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(run_task, range(args.tasks)))
+        wall_time = time.perf_counter() - start
+
+    calls = server_call(args.server, "/__stats")
+    tavily = getattr(run, "tavily", None)
+    if tavily is not None:
+        calls["tavily_calls"] = tavily.stats.snapshot()["tavily_calls"]
+    result = {
+        "agent": args.agent,
+        "concurrency": args.concurrency,
+        "tasks": args.tasks,
+        "errors": len(errors),
+        "first_errors": errors[:3],
+        "wall_time": wall_time,
+        "throughput": args.tasks / wall_time,
+        "task_latency": latency_summary(task_times),
+        "node_latency": {
+            name: latency_summary(values) for name, values in timer.durations.items()
+        },
+        "calls": calls,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    with open(args.result_file, "w") as file:
+        json.dump(result, file)
+
+
+def child_env(server_url):
+    """Point the agents at the stubs and switch off caching"""
+    env = dict(os.environ)
+    env.update(
+        {
+            "OPENAI_BASE_URL": server_url + "/v1",
+            "OPENAI_API_KEY": "stub",
+            "SERPER_URL": server_url + "/search",
+            "SERPER_API_KEY": "stub",
+            "TAVILY_API_KEY": "stub",
+            "SEARCH_CACHE_PATH": "",
+            "SEARCH_CACHE_TTL": "0",
+            "TAVILY_CACHE_TTL": "0",
+            "LLM_CACHE_MODE": "passthrough",
+            "PYTHONWARNINGS": "ignore",
+        }
+    )
+    return env
+
+
+def print_result(result):
+    calls = result["calls"]
+    task = result["task_latency"]
+    print(
+        f"{result['agent']:<12} c={result['concurrency']:<3} "
+        f"wall={result['wall_time']:.2f}s "
+        f"tput={result['throughput']:.2f}/s "
+        f"task p50={task['p50']:.2f}s p95={task['p95']:.2f}s "
+        f"llm={calls['llm_calls']} "
+        f"tokens={calls['prompt_tokens']}+{calls['completion_tokens']} "
+        f"search={calls['search_calls']} pages={calls['page_calls']} "
+        f"tavily={calls['tavily_calls']} "
+        f"rss={result['peak_rss_mb']:.0f}MB errors={result['errors']}"
+    )
+    for name, summary in sorted(result["node_latency"].items()):
+        print(
+            f"    {name:<20} n={summary['count']:<4} p50={summary['p50']:.3f}s "
+            f"p95={summary['p95']:.3f}s p99={summary['p99']:.3f}s"
+        )
+    for error in result["first_errors"]:
+        print(f"    error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--agents", default="pure_python,research,essay")
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--tasks", type=int, default=16)
+    parser.add_argument("--output", help="write all results to this JSON file")
+    for field in fields(StubConfig):
+        parser.add_argument(
+            "--" + field.name.replace("_", "-"), type=field.type, default=field.default
+        )
+    # Internal arguments used to run one benchmark in a child process
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--server", help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.agent = args.child
+        args.concurrency = int(args.concurrency)
+        return run_child(args)
+
+    config = StubConfig(**{f.name: getattr(args, f.name) for f in fields(StubConfig)})
+    server = StubServer(config).start()
+    results = []
+    try:
+        for agent in args.agents.split(","):
+            for concurrency in args.concurrency.split(","):
+                result_file = ROOT / f".bench_{agent}_{concurrency}.json"
+                subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--child",
+                        agent,
+                        "--concurrency",
+                        concurrency,
+                        "--tasks",
+                        str(args.tasks),
+                        "--server",
+                        server.url,
+                        "--config",
+                        json.dumps(asdict(config)),
+                        "--result-file",
+                        str(result_file),
+                    ],
+                    env=child_env(server.url),
+                    cwd=AGENT_DIRS[agent],
+                    check=True,
+                )
+                result = json.loads(result_file.read_text())
+                result_file.unlink()
+                print_result(result)
+                results.append(result)
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"config": asdict(config), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
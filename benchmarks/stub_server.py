@@ -0,0 +1,381 @@
+""" Local stand-ins for the OpenAI, Serper and Tavily APIs used by the benchmarks.
+
+The HTTP stub serves:
+- POST /v1/chat/completions: OpenAI chat completions, streamed or not, with
+  structured output generated from the requested JSON schema
+- POST /search: Serper Google search results
+- GET /page/<n>: an HTML page with navigation, scripts and a body of text
+- GET /__stats and POST /__reset: call and token counters
+
+Latency and payload sizes are configurable, and every response is deterministic.
+"""
+
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "company revenue market growth industry employees london report annual "
+    "research product service customer data platform technology europe share "
+    "profit strategy global retail energy finance health software network"
+).split()
+
+
+@dataclass
+class StubConfig:
+    llm_latency: float = 0.2  # seconds before the first token
+    token_latency: float = 0.0  # seconds between streamed chunks
+    search_latency: float = 0.1
+    page_latency: float = 0.1
+    tavily_latency: float = 0.1
+    completion_words: int = 150  # length of free text completions
+    page_bytes: int = 50_000  # size of the downloaded webpages
+    snippet_words: int = 40  # length of search snippets and Tavily results
+    agent_tool_turns: int = 2  # turns before the pure Python agent answers
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def lorem(n_words, seed):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+class Stats:
+    """Thread safe counters shared by the stubs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {
+                "llm_calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "search_calls": 0,
+                "page_calls": 0,
+                "tavily_calls": 0,
+            }
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+def fake_from_schema(schema, defs=None, seed=0):
+    """Generate a value that validates against a (simple) JSON schema"""
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return fake_from_schema(defs[schema["$ref"].split("/")[-1]], defs, seed)
+    if "anyOf" in schema:
+        return fake_from_schema(schema["anyOf"][0], defs, seed)
+    kind = schema.get("type", "string")
+    if kind == "object":
+        return {
+            name: fake_from_schema(prop, defs, seed + i)
+            for i, (name, prop) in enumerate(schema.get("properties", {}).items())
+        }
+    if kind == "array":
+        return [fake_from_schema(schema["items"], defs, seed + i) for i in range(3)]
+    if kind == "integer":
+        return seed % 3
+    if kind == "number":
+        return float(seed)
+    if kind == "boolean":
+        return True
+    return lorem(6, seed)
+
+
+class StubApp:
+    def __init__(self, config=None):
+        self.config = config or StubConfig()
+        self.stats = Stats()
+        self.base_url = None
+
+    # OpenAI
+
+    def chat_completion(self, request):
+        """Return the completion text, or a tool call, for a chat request"""
+        messages = request.get("messages", [])
+        prompt = "\n".join(str(m.get("content") or "") for m in messages)
+        seed = len(prompt)
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            return json.dumps(fake_from_schema(schema, seed=seed)), None
+        if request.get("tools"):
+            function = request["tools"][0]["function"]
+            arguments = fake_from_schema(function.get("parameters", {}), seed=seed)
+            return None, {"name": function["name"], "arguments": json.dumps(arguments)}
+        if messages and "loop of Thought, Action" in str(messages[0].get("content")):
+            return self.agent_turn(messages, seed), None
+        return lorem(self.config.completion_words, seed), None
+
+    def agent_turn(self, messages, seed):
+        """Script the pure Python agent: search, download a page, then answer"""
+        turn = sum(
+            1
+            for m in messages
+            if m["role"] == "user" and str(m["content"]).startswith("Observation")
+        )
+        if turn >= self.config.agent_tool_turns:
+            return f"Thought: I know the answer.\nAnswer: {lorem(30, seed)}"
+        if turn % 2 == 0:
+            action = f"google_search: {lorem(5, seed)}"
+        else:
+            action = f"download_webpage: {self.base_url}/page/{seed % 1000}"
+        return f"Thought: {lorem(15, seed)}\nAction: {action}\nPAUSE"
+
+    def record_usage(self, request, text, tool_call):
+        prompt_tokens = sum(
+            estimate_tokens(str(m.get("content") or ""))
+            for m in request.get("messages", [])
+        )
+        completion_tokens = estimate_tokens(text or tool_call["arguments"])
+        self.stats.add(
+            llm_calls=1,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return usage
+
+    # Search and pages
+
+    def serper_results(self, query):
+        self.stats.add(search_calls=1)
+        seed = len(query)
+        return {
+            "organic": [
+                {
+                    "title": lorem(5, seed + i),
+                    "link": f"{self.base_url}/page/{(seed + i) % 1000}",
+                    "snippet": lorem(self.config.snippet_words, seed + i),
+                }
+                for i in range(5)
+            ]
+        }
+
+    def page_html(self, number):
+        self.stats.add(page_calls=1)
+        body = []
+        size = 0
+        i = 0
+        while size < self.config.page_bytes:
+            paragraph = f"<p>{lorem(60, number * 1000 + i)}</p>\n"
+            body.append(paragraph)
+            size += len(paragraph)
+            i += 1
+        return (
+            "<html><head><title>Page</title><script>var tracking = 1;</script>"
+            "<style>body { color: black; }</style></head><body>"
+            "<nav>Home About Contact Search Log in</nav>"
+            f"<main><h1>Page {number}</h1>{''.join(body)}</main>"
+            "<footer>Privacy policy Terms of use</footer></body></html>"
+        )
+
+
+def make_handler(app):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real APIs
+
+        def log_message(self, format, *args):
+            pass
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def send_body(self, body, content_type="application/json"):
+            data = body.encode() if isinstance(body, str) else body
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_chunk(self, data):
+            data = data.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == "/__stats":
+                return self.send_body(json.dumps(app.stats.snapshot()))
+            if match := re.match(r"/page/(\d+)", self.path):
+                time.sleep(app.config.page_latency)
+                html = app.page_html(int(match.group(1)))
+                return self.send_body(html, "text/html; charset=utf-8")
+            self.send_error(404)
+
+        def do_POST(self):
+            request = self.read_json()
+            if self.path == "/__reset":
+                app.stats.reset()
+                return self.send_body("{}")
+            if self.path == "/search":
+                time.sleep(app.config.search_latency)
+                return self.send_body(json.dumps(app.serper_results(request["q"])))
+            if self.path.endswith("/chat/completions"):
+                time.sleep(app.config.llm_latency)
+                text, tool_call = app.chat_completion(request)
+                for stop in request.get("stop") or []:
+                    if text and stop in text:
+                        text = text[: text.index(stop)]
+                usage = app.record_usage(request, text, tool_call)
+                if request.get("stream"):
+                    return self.stream_completion(request, text, tool_call, usage)
+                return self.send_body(
+                    json.dumps(completion_body(request, text, tool_call, usage))
+                )
+            self.send_error(404)
+
+        def stream_completion(self, request, text, tool_call, usage):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            if tool_call is not None:
+                deltas = [
+                    {
+                        "role": "assistant",
+                        "tool_calls": [
+                            {
+                                "index": 0,
+                                "id": "call_stub",
+                                "type": "function",
+                                "function": tool_call,
+                            }
+                        ],
+                    }
+                ]
+            else:
+                # One chunk per word, like the real API sends a few tokens at a time
+                deltas = [{"role": "assistant", "content": ""}] + [
+                    {"content": piece} for piece in re.findall(r"\S*\s*", text) if piece
+                ]
+            finish = "tool_calls" if tool_call else "stop"
+            for delta in deltas:
+                self.send_event(request, [choice(delta, None)])
+                if app.config.token_latency:
+                    time.sleep(app.config.token_latency)
+            self.send_event(request, [choice({}, finish)])
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self.send_event(request, [], usage)
+            self.send_chunk("data: [DONE]\n\n")
+            self.send_chunk("")
+
+        def send_event(self, request, choices, usage=None):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": choices,
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            self.send_chunk(f"data: {json.dumps(chunk)}\n\n")
+
+    return Handler
+
+
+def choice(delta, finish_reason):
+    return {"index": 0, "delta": delta, "finish_reason": finish_reason}
+
+
+def completion_body(request, text, tool_call, usage):
+    message = {"role": "assistant", "content": text, "refusal": None}
+    if tool_call is not None:
+        message["tool_calls"] = [
+            {"id": "call_stub", "type": "function", "function": tool_call}
+        ]
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "stub"),
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if tool_call else "stop",
+                "logprobs": None,
+            }
+        ],
+        "usage": usage,
+    }
+
+
+class StubServer:
+    """Run the HTTP stubs in a background thread"""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.app = StubApp(config)
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(self.app))
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.app.base_url = self.url
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeTavilyClient:
+    """In-process stand-in for tavily.TavilyClient"""
+
+    def __init__(self, config=None):
+        self.config = config or StubConfig()
+        self.stats = Stats()
+
+    def search(self, query, max_results=5, **kwargs):
+        time.sleep(self.config.tavily_latency)
+        return self.results(query, max_results)
+
+    def results(self, query, max_results):
+        self.stats.add(tavily_calls=1)
+        seed = len(query)
+        return {
+            "query": query,
+            "results": [
+                {
+                    "title": lorem(5, seed + i),
+                    "url": f"https://example.com/{seed + i}",
+                    "content": lorem(self.config.snippet_words, seed + i),
+                    "score": 0.9,
+                }
+                for i in range(max_results)
+            ],
+        }
+
+
+class FakeAsyncTavilyClient(FakeTavilyClient):
+    """In-process stand-in for tavily.AsyncTavilyClient"""
+
+    async def search(self, query, max_results=5, **kwargs):
+        await asyncio.sleep(self.config.tavily_latency)
+        return self.results(query, max_results)
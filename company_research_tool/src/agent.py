@@ -7,10 +7,19 @@ from dotenv import load_dotenv
 
 _ = load_dotenv()
 
+import asyncio
+import contextvars
+import functools
 import operator
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Annotated, List, TypedDict
 
+import aiosqlite
+from checkpointer import CHECKPOINT_MAX_PER_THREAD, BoundedMemorySaver
+from content_pipeline import estimate_tokens, select_content
+from content_store import CONTENT_STORE_PATH, ContentStore, add_ids
 from langchain_core.messages import (
     AIMessage,
     AnyMessage,
@@ -18,12 +27,58 @@ from langchain_core.messages import (
     HumanMessage,
     SystemMessage,
 )
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import END, StateGraph
-from prompts import RESEARCH_PLAN_PROMPT, WRITER_PROMPT
+from llm_cache import get_llm_cache
+from prompts import BATCH_WRITER_PROMPT, RESEARCH_PLAN_PROMPT, WRITER_PROMPT
 from pydantic import BaseModel
-from tavily import TavilyClient
+from tavily import AsyncTavilyClient, TavilyClient
+from tavily_cache import get_tavily_cache
+from tracing import callbacks, span, traced
+
+# The searches of a node run concurrently on this pool, shared by all graph runs
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TAVILY_MAX_WORKERS", "16"))
+)
+# Request timeout of each search, in seconds, from when it starts rather than
+# when it is queued. Results of searches that time out are left out
+SEARCH_TIMEOUT = float(os.getenv("TAVILY_TIMEOUT", "30"))
+# Time a node waits for all its searches, in seconds, from when it starts them.
+# Searches still queued or running then are dropped. No deadline when 0
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "60"))
+# Search responses are reused across graph runs and threads
+tavily_cache = get_tavily_cache()
+# Estimated prompt tokens of the research packed in one batched extraction call
+EXTRACT_BATCH_TOKENS = int(os.getenv("EXTRACT_BATCH_TOKENS", "12000"))
+# SQLite file for the graph checkpoints. In memory when empty
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "")
+
+
+def make_checkpointer(path=CHECKPOINT_DB):
+    """Return an SQLite checkpointer when path is set, so runs survive a restart,
+    or else a memory-bounded one"""
+    if path:
+        return SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+    # A company only needs its latest checkpoints to finish its run
+    return BoundedMemorySaver(max_checkpoints_per_thread=CHECKPOINT_MAX_PER_THREAD or 2)
+
+
+async def amake_checkpointer(path=CHECKPOINT_DB):
+    """make_checkpointer for graphs run with ainvoke or astream: an async SQLite
+    checkpointer when path is set. Call it from the event loop that runs the graph."""
+    if path:
+        return AsyncSqliteSaver(await aiosqlite.connect(path))
+    return make_checkpointer(path)
+
+
+def make_content_store(path=CHECKPOINT_DB):
+    """Return a store for the research content. It is kept in the checkpoint
+    file when there is one, so resumed runs find the content of their checkpoints"""
+    return ContentStore(path or CONTENT_STORE_PATH)
 
 
 class AgentState(TypedDict):
@@ -31,7 +86,8 @@ class AgentState(TypedDict):
     lnode: str
     plan: str
     draft: str
-    content: List[str]
+    # IDs of the research snippets in the content store
+    content: Annotated[List[str], add_ids]
     queries: List[str]
     count: Annotated[int, operator.add]
 
@@ -50,47 +106,211 @@ class CompanyInfo(BaseModel):
     company_website: str
 
 
+class NumberedCompanyInfo(CompanyInfo):
+    company_number: int
+
+
+class CompanyInfoBatch(BaseModel):
+    companies: List[NumberedCompanyInfo]
+
+
+def pack_batches(items, sizes, max_tokens=EXTRACT_BATCH_TOKENS, max_items=None):
+    """Split items into consecutive batches whose sizes add up to at most
+    max_tokens, with at most max_items each. An item over the budget gets its own batch.
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for item, size in zip(items, sizes):
+        full = max_items is not None and len(batch) >= max_items
+        if batch and (full or batch_tokens + size > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def results_content(response, search_span):
+    """Content of the results of a Tavily response, recorded on the search span"""
+    content = [r["content"] for r in response["results"]]
+    search_span.set(results=len(content), output_chars=sum(map(len, content)))
+    return content
+
+
+def searches_content(queries, searches, pending=()):
+    """Content of the finished searches (futures or tasks), in the order of the
+    queries. Failed searches, and the pending ones dropped at the deadline, are
+    skipped."""
+    content = []
+    for query, search in zip(queries, searches):
+        if search in pending:
+            print(f"Search dropped at the deadline of the node: {query}")
+        elif search.exception() is not None:
+            print(f"Search failed: {query}: {search.exception()}")
+        else:
+            content.extend(search.result())
+    return content
+
+
 class eresearcher:
-    def __init__(self):
+    def __init__(self, checkpointer=None, content_store=None):
 
         # Initialize the model and the Tavily client
-        self.model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        # LLM calls are recorded or replayed depending on LLM_CACHE_MODE
+        # and traced when AGENT_TRACE is set
+        self.model = ChatOpenAI(
+            model="gpt-4o-mini",
+            temperature=0,
+            cache=get_llm_cache(),
+            callbacks=callbacks(),
+        )
         self.tavily = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+        self.atavily = AsyncTavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+        # Research text is stored once, the state holds its IDs. Checkpoints on
+        # disk need their content on disk too
+        if content_store is None:
+            if checkpointer is not None and not isinstance(checkpointer, MemorySaver):
+                raise ValueError(
+                    "pass the content store of the checkpoint file with a persistent"
+                    " checkpointer: content_store=make_content_store(path)"
+                )
+            content_store = make_content_store()
+        self.content_store = content_store
 
         # Define the prompts
         self.WRITER_PROMPT = WRITER_PROMPT
+        self.BATCH_WRITER_PROMPT = BATCH_WRITER_PROMPT
         self.RESEARCH_PLAN_PROMPT = RESEARCH_PLAN_PROMPT
 
         # Create the graph
-        # Nodes
+        # Nodes. invoke and stream run the sync version, ainvoke and astream the async one
         builder = StateGraph(AgentState)
-        builder.add_node("research_plan", self.research_plan_node)
-        builder.add_node("generate", self.generation_node)
+        builder.add_node(
+            "research_plan",
+            RunnableLambda(self.research_plan_node, afunc=self.aresearch_plan_node),
+        )
+        builder.add_node(
+            "generate",
+            RunnableLambda(self.generation_node, afunc=self.ageneration_node),
+        )
         builder.set_entry_point("research_plan")
         # Edges
         builder.add_edge("research_plan", "generate")
         builder.add_edge("generate", END)
 
         # Compile graph with memory and interrupt states
-        checkpointer = MemorySaver()
+        if checkpointer is None:
+            checkpointer = make_checkpointer()
         self.graph = builder.compile(
             checkpointer=checkpointer,
         )
+        # Only the threads the graph has finished are evicted from memory
+        if isinstance(checkpointer, BoundedMemorySaver):
+            checkpointer.bind(self.graph)
 
-    # Node definitions
+    def search(self, query, max_results=2, timeout=SEARCH_TIMEOUT):
+        """Search the web with Tavily and return the content of the results"""
+        with span("tavily.search", "tool", input_chars=len(query)) as search_span:
+            search_fn = functools.partial(
+                self.tavily.search,
+                query=query,
+                max_results=max_results,
+                timeout=timeout,
+            )
+            if tavily_cache is not None:
+                response = tavily_cache.search(query, max_results, search_fn)
+            else:
+                response = search_fn()
+            return results_content(response, search_span)
 
-    def research_plan_node(self, state: AgentState):
-        queries = self.model.with_structured_output(Queries).invoke(
-            [
-                SystemMessage(content=self.RESEARCH_PLAN_PROMPT),
-                HumanMessage(content=state["task"]),
-            ]
-        )
-        content = state.get("content", [])  # add to content
-        for q in queries.queries:
-            response = self.tavily.search(query=q, max_results=2)
-            for r in response["results"]:
-                content.append(r["content"])
+    async def asearch(self, query, max_results=2, timeout=SEARCH_TIMEOUT):
+        """search with the async Tavily client"""
+        with span("tavily.search", "tool", input_chars=len(query)) as search_span:
+            search_fn = functools.partial(
+                self.atavily.search,
+                query=query,
+                max_results=max_results,
+                timeout=timeout,
+            )
+            if tavily_cache is not None:
+                response = await tavily_cache.asearch(query, max_results, search_fn)
+            else:
+                response = await search_fn()
+            return results_content(response, search_span)
+
+    def search_all(self, queries, timeout=SEARCH_TIMEOUT, deadline=SEARCH_DEADLINE):
+        """Run the searches concurrently and return the content of the results, in
+        the order of the queries. Failed and timed out searches are skipped.
+
+        The timeout applies to each search from when a worker starts it. The
+        deadline bounds the whole call: searches not done by then, including
+        those still waiting for a worker, are cancelled and skipped."""
+        futures = [
+            search_executor.submit(
+                contextvars.copy_context().run, self.search, q, timeout=timeout
+            )
+            for q in queries
+        ]
+        _, pending = wait(futures, timeout=deadline or None)
+        # A running search cannot be cancelled, it ends at its own timeout
+        for future in pending:
+            future.cancel()
+        return searches_content(queries, futures, pending)
+
+    async def asearch_all(
+        self, queries, timeout=SEARCH_TIMEOUT, deadline=SEARCH_DEADLINE
+    ):
+        """search_all on the event loop"""
+        tasks = [
+            asyncio.ensure_future(self.asearch(q, timeout=timeout)) for q in queries
+        ]
+        pending = set()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=deadline or None)
+        for task in pending:
+            task.cancel()
+        return searches_content(queries, tasks, pending)
+
+    def extract_batch(self, companies):
+        """Extract the information of several companies with one call.
+
+        companies is a list of (company, selected content). Returns a dict of position in
+        companies -> CompanyInfo. Companies missing from the response are left out.
+        """
+        sections = [
+            f"Company {number}: {company}\n" + "\n\n".join(content)
+            for number, (company, content) in enumerate(companies, start=1)
+        ]
+        messages = [
+            SystemMessage(
+                content=self.BATCH_WRITER_PROMPT.format(content="\n\n".join(sections))
+            ),
+        ]
+        response = self.model.with_structured_output(CompanyInfoBatch).invoke(messages)
+        extracted = {}
+        for info in response.companies:
+            position = info.company_number - 1
+            if 0 <= position < len(companies) and position not in extracted:
+                extracted[position] = CompanyInfo(
+                    **info.model_dump(exclude={"company_number"})
+                )
+        return extracted
+
+    # Node definitions. The messages and the state update of each node are built
+    # by its helpers, shared by the sync node and the async one used by ainvoke
+    # and astream. The async nodes run the content store, which blocks on SQLite,
+    # in a thread
+
+    def research_plan_messages(self, state):
+        return [
+            SystemMessage(content=self.RESEARCH_PLAN_PROMPT),
+            HumanMessage(content=state["task"]),
+        ]
+
+    def research_plan_update(self, queries, content):
+        # Only the IDs of the new content, the reducer appends them
         return {
             "content": content,
             "queries": queries.queries,
@@ -98,14 +318,50 @@ class eresearcher:
             "count": 1,
         }
 
-    def generation_node(self, state: AgentState):
-        content = "\n\n".join(state["content"] or [])
-        messages = [
+    @traced("node.research_plan", "node")
+    def research_plan_node(self, state: AgentState):
+        queries = self.model.with_structured_output(Queries).invoke(
+            self.research_plan_messages(state)
+        )
+        content = self.content_store.put(self.search_all(queries.queries))
+        return self.research_plan_update(queries, content)
+
+    @traced("node.research_plan", "node")
+    async def aresearch_plan_node(self, state: AgentState):
+        queries = await self.model.with_structured_output(Queries).ainvoke(
+            self.research_plan_messages(state)
+        )
+        content = await asyncio.to_thread(
+            self.content_store.put, await self.asearch_all(queries.queries)
+        )
+        return self.research_plan_update(queries, content)
+
+    def generation_messages(self, state, snippets):
+        # Only the most relevant research, without duplicates, fits in the prompt
+        content = "\n\n".join(select_content(snippets, state["task"]))
+        return [
             SystemMessage(content=self.WRITER_PROMPT.format(content=content)),
         ]
-        response = self.model.with_structured_output(CompanyInfo).invoke(messages)
+
+    def generation_update(self, response):
         return {
             "draft": response,
             "lnode": "generate",
             "count": 1,
         }
+
+    @traced("node.generate", "node")
+    def generation_node(self, state: AgentState):
+        snippets = self.content_store.get(state["content"])
+        response = self.model.with_structured_output(CompanyInfo).invoke(
+            self.generation_messages(state, snippets)
+        )
+        return self.generation_update(response)
+
+    @traced("node.generate", "node")
+    async def ageneration_node(self, state: AgentState):
+        snippets = await asyncio.to_thread(self.content_store.get, state["content"])
+        response = await self.model.with_structured_output(CompanyInfo).ainvoke(
+            self.generation_messages(state, snippets)
+        )
+        return self.generation_update(response)
@@ -0,0 +1,96 @@
+""" Content-addressed store of the research snippets.
+
+The graph state only holds the IDs of the snippets (a hash of their text), and
+the text is stored once here. Checkpoints then grow with the new IDs of each
+step instead of holding another copy of all the research.
+
+The texts are kept in an SQLite table, with the most recently used ones also in
+memory, so a long-running process does not hold all of them in memory. With a
+path the table is in that file, available to the checkpoints of later runs.
+Without one it is in a private temporary file, deleted when the process ends.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+CONTENT_STORE_PATH = os.getenv("CONTENT_STORE_PATH", "")
+# Texts kept in memory in front of the SQLite table
+CONTENT_STORE_CACHE = int(os.getenv("CONTENT_STORE_CACHE", "4096"))
+
+
+def content_id(text):
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def add_ids(ids, new_ids):
+    """State reducer: append the IDs that are not already in the list"""
+    ids = list(ids or [])
+    seen = set(ids)
+    for new_id in new_ids or []:
+        if new_id not in seen:
+            seen.add(new_id)
+            ids.append(new_id)
+    return ids
+
+
+class ContentStore:
+    """Texts keyed by content_id. Safe to share between threads"""
+
+    def __init__(self, path=CONTENT_STORE_PATH, cache_size=CONTENT_STORE_CACHE):
+        self.cache_size = cache_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # SQLite opens a private temporary database for an empty path
+        self.conn = sqlite3.connect(path or "", check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS content (id TEXT PRIMARY KEY, text TEXT)"
+        )
+        self.conn.commit()
+
+    def put(self, texts):
+        """Store the texts and return their IDs, in the same order"""
+        ids = [content_id(text) for text in texts]
+        with self.lock:
+            new = [(i, t) for i, t in zip(ids, texts) if i not in self.memory]
+            for i, text in zip(ids, texts):
+                self._remember(i, text)
+            if new:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO content VALUES (?, ?)", new
+                )
+                self.conn.commit()
+        return ids
+
+    def get(self, ids):
+        """Return the texts of the IDs, in the same order. Raises KeyError for an
+        unknown ID"""
+        texts = []
+        with self.lock:
+            for i in ids or []:
+                text = self.memory.get(i)
+                if text is None:
+                    row = self.conn.execute(
+                        "SELECT text FROM content WHERE id = ?", (i,)
+                    ).fetchone()
+                    text = row[0] if row is not None else None
+                if text is None:
+                    raise KeyError(f"Unknown content ID: {i}")
+                self._remember(i, text)
+                texts.append(text)
+        return texts
+
+    def _remember(self, content_id, text):
+        self.memory[content_id] = text
+        self.memory.move_to_end(content_id)
+        while len(self.memory) > self.cache_size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory_entries": len(self.memory),
+                "memory_chars": sum(map(len, self.memory.values())),
+            }
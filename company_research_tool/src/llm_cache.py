@@ -0,0 +1,141 @@
+""" Record/replay cache for LLM calls, stored in a local SQLite file.
+
+Modes (LLM_CACHE_MODE environment variable):
+- passthrough: no caching, every call goes to the API (default)
+- record: serve cached responses, call the API and store the response on a miss
+- replay: only serve cached responses, a miss raises LLMCacheMiss
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import warnings
+from typing import Any, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+from pydantic import BaseModel
+
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "passthrough")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class LLMCacheMiss(Exception):
+    """Raised in replay mode when a call has no recorded response"""
+
+
+class LLMCache(BaseCache):
+    """LangChain cache keyed on a hash of the prompt and the model settings.
+
+    The least recently used responses are evicted once the stored responses
+    take more than max_bytes.
+    """
+
+    def __init__(
+        self, path=LLM_CACHE_PATH, mode=LLM_CACHE_MODE, max_bytes=LLM_CACHE_MAX_BYTES
+    ):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown LLM cache mode: {mode}")
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache "
+            "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)"
+        )
+        self.conn.commit()
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM llm_cache"
+        ).fetchone()[0]
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        key = self._key(prompt, llm_string)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE llm_cache SET last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                self.conn.commit()
+        if row is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")  # loads is marked as beta
+                return loads(row[0])
+        if self.mode == "replay":
+            raise LLMCacheMiss(f"No recorded response for LLM call {key}")
+        return None
+
+    def update(
+        self, prompt: str, llm_string: str, return_val: Sequence[Generation]
+    ) -> None:
+        if self.mode != "record":
+            return
+        value = dumps([_serializable(generation) for generation in return_val])
+        key = self._key(prompt, llm_string)
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self.total_bytes += len(value) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """Delete the least recently used responses until the cache is at 90% of max_bytes"""
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute(
+            "SELECT key, size FROM llm_cache ORDER BY last_used"
+        ).fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.total_bytes -= size
+
+    def clear(self, **kwargs: Any) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache")
+            self.conn.commit()
+            self.total_bytes = 0
+
+
+def _serializable(generation):
+    """Structured output responses carry the parsed pydantic object, which
+    cannot be serialized. Store it as a dict, which the output parser accepts."""
+    message = getattr(generation, "message", None)
+    parsed = message.additional_kwargs.get("parsed") if message else None
+    if isinstance(parsed, BaseModel):
+        message = message.model_copy(
+            update={
+                "additional_kwargs": {
+                    **message.additional_kwargs,
+                    "parsed": parsed.model_dump(),
+                }
+            }
+        )
+        generation = generation.model_copy(update={"message": message})
+    return generation
+
+
+def get_llm_cache():
+    """Return the cache for the mode set in LLM_CACHE_MODE, or None in passthrough mode"""
+    if LLM_CACHE_MODE == "passthrough":
+        return None
+    return LLMCache()
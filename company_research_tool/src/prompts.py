@@ -10,6 +10,18 @@ WRITER_PROMPT = (
     "{content}"
 )
 
+BATCH_WRITER_PROMPT = (
+    "You are a research assistant tasked with extracting company information from the research. "
+    "The research below covers several companies, each under its own numbered heading. "
+    "Return one entry per company, with company_number set to the number of its heading. "
+    "Only use the research under a company's heading for that company. "
+    "Clearly state if the information is not available. "
+    "If the information relates to several companies with the same name, provide the information for UK-based company, if available. "
+    "Keep the information concise and to the point. Company descriptions should be no longer than 200 characters. \n"
+    "------\n"
+    "{content}"
+)
+
 RESEARCH_PLAN_PROMPT = (
     "You are a researcher charged with providing information that can "
     "be used when writing an overview for the following company. The overview should "
@@ -1,11 +1,38 @@
 """Script to process a list of companies using the agent and save the results to a CSV file"""
+
+import argparse
+import asyncio
+import csv
+import io
+import os
+import threading
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
-from agent import eresearcher
+from agent import (
+    CHECKPOINT_DB,
+    CompanyInfo,
+    amake_checkpointer,
+    eresearcher,
+    make_checkpointer,
+    make_content_store,
+    pack_batches,
+    tavily_cache,
+)
+from checkpointer import BoundedMemorySaver
+from content_pipeline import estimate_tokens, select_content
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 warnings.filterwarnings("ignore")
 
+# Number of companies researched at the same time
+MAX_WORKERS = int(os.getenv("RESEARCH_MAX_WORKERS", "8"))
+# Companies whose information is extracted together in one call. 1 for one call each
+EXTRACT_BATCH_SIZE = int(os.getenv("EXTRACT_BATCH_SIZE", "1"))
+OUTPUT_COLUMNS = ["Company Name"] + list(CompanyInfo.model_fields)
+
 
 def read_companies(filepath):
     """Function to read company names from a CSV file"""
@@ -13,50 +40,390 @@ def read_companies(filepath):
     return companies["Company Name"].tolist()
 
 
+def read_done(filepath):
+    """Return the names of the companies already saved in the output file.
+
+    A crash can leave the last row partially written. The file is rewritten
+    without an unterminated last line and without rows of the wrong number of
+    columns, so new rows are appended cleanly and the incomplete companies are
+    researched again. Rows with empty values are kept.
+    """
+    if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+        return set()
+    with open(filepath, newline="") as f:
+        text = f.read()
+    # Drop the unterminated last line
+    text = text[: text.rfind("\n") + 1]
+    rows = []
+    reader = csv.reader(io.StringIO(text), strict=True)
+    header = next(reader, None)
+    try:
+        for row in reader:
+            rows.append(row)
+    except csv.Error:  # the last row was cut inside a quoted value
+        pass
+    if header is None or "Company Name" not in header:
+        with open(filepath, "w", newline="") as f:
+            f.write(text)
+        return set()
+    complete = [row for row in rows if len(row) == len(header)]
+    # Written to a temporary file first, so a crash now loses no rows
+    with open(filepath + ".tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(complete)
+    os.replace(filepath + ".tmp", filepath)
+    name = header.index("Company Name")
+    return {row[name] for row in complete}
+
+
+class CsvAppender:
+    """Append rows to a CSV file as soon as they are ready. Safe to share between threads"""
+
+    def __init__(self, filepath, columns=OUTPUT_COLUMNS, append=False):
+        has_header = append and os.path.exists(filepath) and os.path.getsize(filepath)
+        self.lock = threading.Lock()
+        self.file = open(filepath, "a" if append else "w", newline="")
+        self.writer = csv.DictWriter(self.file, columns, extrasaction="ignore")
+        if not has_header:
+            self.writer.writeheader()
+            self.file.flush()
+
+    def write(self, row):
+        with self.lock:
+            self.writer.writerow(row)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
 def process_company(company, thread_id, agent):
     """Function to process a single company using the agent"""
     print(f"Processing {company}")
     thread = {"configurable": {"thread_id": f"{thread_id}"}}
-    result = agent.graph.invoke(
-        {
-            "task": company,
-        },
-        thread,
-    )
     try:
+        # With a persistent checkpointer, a run interrupted by a restart is
+        # continued from its last checkpoint instead of starting again
+        state = agent.graph.get_state(thread)
+        if state.next:
+            result = agent.graph.invoke(None, thread)
+        elif state.values.get("draft"):
+            result = state.values
+        else:
+            result = agent.graph.invoke(
+                {
+                    "task": company,
+                },
+                thread,
+            )
+        return result.get("draft").dict()
+    except Exception as e:
+        print(f"Skipping {company}: {e}")
+        return None
+
+
+async def aprocess_company(company, thread_id, agent):
+    """process_company for the async mode"""
+    print(f"Processing {company}")
+    thread = {"configurable": {"thread_id": f"{thread_id}"}}
+    try:
+        state = await agent.graph.aget_state(thread)
+        if state.next:
+            result = await agent.graph.ainvoke(None, thread)
+        elif state.values.get("draft"):
+            result = state.values
+        else:
+            result = await agent.graph.ainvoke(
+                {
+                    "task": company,
+                },
+                thread,
+            )
         return result.get("draft").dict()
     except Exception as e:
         print(f"Skipping {company}: {e}")
         return None
 
 
+def thread_id(index, company):
+    """Thread IDs stay the same across restarts, so runs can be resumed"""
+    return f"{index + 1}-{company}"
+
+
+def process_batch(batch, agent, batched=True):
+    """Research a batch of companies, then extract their information with as few
+    batched calls as the token budget allows. Companies missing from a batched
+    response are extracted on their own. batch is a list of (index, company).
+    Returns a list of (index, company data or None)"""
+    if not batched:
+        return [
+            (index, process_company(company, thread_id(index, company), agent))
+            for index, company in batch
+        ]
+    threads = {
+        index: {"configurable": {"thread_id": thread_id(index, company)}}
+        for index, company in batch
+    }
+    # Research every company concurrently, stopping before the extraction
+    inputs, configs = [], []
+    for index, company in batch:
+        state = agent.graph.get_state(threads[index])
+        if state.next == ("generate",) or (not state.next and state.values):
+            continue
+        print(f"Processing {company}")
+        inputs.append(None if state.next else {"task": company})
+        configs.append(threads[index])
+    agent.graph.batch(
+        inputs, configs, interrupt_before=["generate"], return_exceptions=True
+    )
+
+    waiting = []
+    for index, company in batch:
+        state = agent.graph.get_state(threads[index])
+        if state.next == ("generate",):
+            snippets = agent.content_store.get(state.values.get("content"))
+            content = select_content(snippets, company)
+            waiting.append((index, company, content))
+    sizes = [estimate_tokens("\n\n".join(content)) for _, _, content in waiting]
+    for group in pack_batches(waiting, sizes):
+        try:
+            extracted = agent.extract_batch(
+                [(company, content) for _, company, content in group]
+            )
+        except Exception as e:
+            print(f"Batched extraction failed, extracting one by one: {e}")
+            extracted = {}
+        for position, (index, company, _) in enumerate(group):
+            if position in extracted:
+                # Record the extraction as the output of the generate node
+                agent.graph.update_state(
+                    threads[index],
+                    {"draft": extracted[position], "lnode": "generate", "count": 1},
+                    as_node="generate",
+                )
+
+    # Finish the companies the batches missed, and collect all the results
+    return [
+        (index, process_company(company, thread_id(index, company), agent))
+        for index, company in batch
+    ]
+
+
+def process_companies(
+    companies,
+    agent,
+    max_workers=MAX_WORKERS,
+    writer=None,
+    skip=frozenset(),
+    batch_size=EXTRACT_BATCH_SIZE,
+):
+    """Process the companies concurrently, except those in skip. With batch_size
+    above 1, each worker processes batch_size companies at a time, extracting
+    their information with batched calls. Each result is written as soon as it
+    is ready. Returns the data of the processed companies in input order, with
+    None for the companies that failed or were skipped"""
+    results = [None] * len(companies)
+    pending = [
+        (index, company)
+        for index, company in enumerate(companies)
+        if company not in skip
+    ]
+    print(
+        f"{len(companies) - len(pending)} companies already done, {len(pending)} to run"
+    )
+    progress = Progress(companies, len(pending), results, writer)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if batch_size > 1:
+            futures = [
+                executor.submit(process_batch, pending[i : i + batch_size], agent)
+                for i in range(0, len(pending), batch_size)
+            ]
+        else:
+            futures = [
+                executor.submit(process_batch, [(index, company)], agent, batched=False)
+                for index, company in pending
+            ]
+        for future in as_completed(futures):
+            for index, company_data in future.result():
+                progress.add(index, company_data)
+    return results
+
+
+async def aprocess_companies(
+    companies,
+    agent,
+    max_workers=MAX_WORKERS,
+    writer=None,
+    skip=frozenset(),
+):
+    """process_companies on one event loop: up to max_workers companies are in
+    progress at once, without a thread each"""
+    results = [None] * len(companies)
+    pending = [
+        (index, company)
+        for index, company in enumerate(companies)
+        if company not in skip
+    ]
+    print(
+        f"{len(companies) - len(pending)} companies already done, {len(pending)} to run"
+    )
+    progress = Progress(companies, len(pending), results, writer)
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def run(index, company):
+        async with semaphore:
+            company_data = await aprocess_company(
+                company, thread_id(index, company), agent
+            )
+            return index, company_data
+
+    for future in asyncio.as_completed([run(*item) for item in pending]):
+        progress.add(*await future)
+    return results
+
+
+class Progress:
+    """Record the results as they come in: store them, write them and print the progress"""
+
+    def __init__(self, companies, total, results, writer=None):
+        self.companies = companies
+        self.total = total
+        self.results = results
+        self.writer = writer
+        self.done = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+
+    def add(self, index, company_data):
+        self.results[index] = company_data
+        self.done += 1
+        if company_data is None:
+            self.failed += 1
+        elif self.writer is not None:
+            self.writer.write({"Company Name": self.companies[index], **company_data})
+        elapsed = time.perf_counter() - self.start
+        remaining = elapsed / self.done * (self.total - self.done)
+        print(
+            f"Finished {self.done}/{self.total} ({self.failed} failed), "
+            f"{elapsed:.0f}s elapsed, about {remaining:.0f}s left: {self.companies[index]}"
+        )
+
+
 def save_data(data, filepath):
     """Function to save the processed data to a CSV file"""
     df = pd.DataFrame(data)
     df.to_csv(filepath, index=False)
 
 
-def main():
-    """Main function to process the list of companies. Saves the data to a CSV file"""
+def sort_output(filepath, companies):
+    """Rewrite the output file with the rows in the order of the input companies"""
+    order = {company: index for index, company in reversed(list(enumerate(companies)))}
+    saved = pd.read_csv(filepath, on_bad_lines="skip")
+    saved = saved.sort_values(
+        "Company Name", key=lambda names: names.map(order), kind="stable"
+    )
+    save_data(saved, filepath)
+
+
+async def arun_companies(companies, max_workers, writer, skip, checkpoint_db):
+    """Create the agent on the event loop, which the async checkpointer needs, and
+    process the companies in async mode. Returns the agent."""
+    checkpointer = await amake_checkpointer(checkpoint_db)
+    agent = eresearcher(
+        checkpointer=checkpointer, content_store=make_content_store(checkpoint_db)
+    )
+    try:
+        await aprocess_companies(companies, agent, max_workers, writer, skip=skip)
+    finally:
+        if isinstance(checkpointer, AsyncSqliteSaver):
+            await checkpointer.conn.close()
+    return agent
+
+
+def main(
+    filepath="company_research_tool/data/companies.csv",
+    output_filepath="company_research_tool/data/companies_data.csv",
+    max_workers=MAX_WORKERS,
+    resume=False,
+    checkpoint_db=CHECKPOINT_DB,
+    batch_size=EXTRACT_BATCH_SIZE,
+    use_async=False,
+):
+    """Main function to process the list of companies. Saves the data to a CSV file.
+    With resume, the companies already in the output file are skipped. With
+    use_async, the graphs run on one event loop instead of a thread each."""
 
     # Read the list of companies from input csv file
-    filepath = "company_research_tool/data/companies.csv"
-    output_filepath = "company_research_tool/data/companies_data.csv"
     companies = read_companies(filepath)
+    done = read_done(output_filepath) if resume else set()
 
-    # Initialize the agent
-    agent = eresearcher()
-    list_of_companies = []
-
-    # Process each company and collect the results
-    for thread_id, company in enumerate(companies, start=1):
-        company_data = process_company(company, thread_id, agent)
-        if company_data:
-            list_of_companies.append(company_data)
+    # Process the companies, appending each one to the output file when it is done
+    writer = CsvAppender(output_filepath, append=resume)
+    try:
+        if use_async:
+            agent = asyncio.run(
+                arun_companies(companies, max_workers, writer, done, checkpoint_db)
+            )
+        else:
+            # Initialize the agent
+            agent = eresearcher(
+                checkpointer=make_checkpointer(checkpoint_db),
+                content_store=make_content_store(checkpoint_db),
+            )
+            process_companies(
+                companies, agent, max_workers, writer, skip=done, batch_size=batch_size
+            )
+    finally:
+        writer.close()
 
-    # Save the collected data to a CSV file
-    save_data(list_of_companies, output_filepath)
+    # Companies finish in any order: sort the CSV file like the input
+    sort_output(output_filepath, companies)
+    if tavily_cache is not None:
+        print(f"Tavily cache: {tavily_cache.stats()}")
+    if isinstance(agent.graph.checkpointer, BoundedMemorySaver):
+        print(f"Checkpoints: {agent.graph.checkpointer.stats()}")
+    print(f"Content store: {agent.content_store.stats()}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Research a list of companies")
+    parser.add_argument("--input", default="company_research_tool/data/companies.csv")
+    parser.add_argument(
+        "--output", default="company_research_tool/data/companies_data.csv"
+    )
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the companies already in the output file",
+    )
+    parser.add_argument(
+        "--checkpoint-db",
+        default=CHECKPOINT_DB,
+        help="SQLite file for the graph checkpoints, to resume interrupted runs",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=EXTRACT_BATCH_SIZE,
+        help="companies extracted together in one LLM call",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="run the graphs on one event loop, --workers companies at a time",
+    )
+    args = parser.parse_args()
+    if args.use_async and args.batch_size > 1:
+        parser.error("--async extracts each company on its own, use --batch-size 1")
+    main(
+        args.input,
+        args.output,
+        args.workers,
+        args.resume,
+        args.checkpoint_db,
+        args.batch_size,
+        args.use_async,
+    )
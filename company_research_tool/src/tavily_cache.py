@@ -0,0 +1,179 @@
+""" Cache of Tavily search responses shared by all the graph runs of a process.
+
+Responses are kept in an in-memory LRU in front of an SQLite table on disk, so
+they are reused across threads and runs, keyed on the normalized query and
+max_results. Concurrent requests for the same key are coalesced: one thread
+or coroutine calls the API and the others wait for its response.
+"""
+
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+TAVILY_CACHE_PATH = os.getenv("TAVILY_CACHE_PATH", "tavily_cache.sqlite")
+TAVILY_CACHE_TTL = float(os.getenv("TAVILY_CACHE_TTL", str(7 * 24 * 60 * 60)))
+TAVILY_CACHE_SIZE = int(os.getenv("TAVILY_CACHE_SIZE", "4096"))
+
+
+def normalize_query(query):
+    """Lowercase the query and collapse whitespace so trivial variations share a key"""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class TavilyCache:
+    """Cache of search responses. Entries older than ttl seconds are ignored.
+    Set path to None to keep the cache in memory only."""
+
+    def __init__(
+        self,
+        path=TAVILY_CACHE_PATH,
+        ttl=TAVILY_CACHE_TTL,
+        max_entries=TAVILY_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tavily_cache "
+                "(key TEXT PRIMARY KEY, created REAL, value TEXT)"
+            )
+            self.conn.commit()
+
+    @staticmethod
+    def key(query, max_results):
+        return f"{max_results}:{normalize_query(query)}"
+
+    def search(self, query, max_results, search_fn):
+        """Return the cached response, or call search_fn() once for all the
+        threads asking for the same query at the same time"""
+        key = self.key(query, max_results)
+        with self.lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            value = search_fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self._store(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    async def asearch(self, query, max_results, search_fn):
+        """search for coroutines: search_fn is a coroutine function, and waiting
+        for another caller's request does not block the event loop"""
+        key = self.key(query, max_results)
+        with self.lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            # Shielded: a waiter that times out must not cancel the leader's request
+            return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            value = await search_fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self._store(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def _lookup(self, key):
+        """Return the value for key from memory or disk and count the hit, or None"""
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None and now - entry[0] < self.ttl:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if self.conn is not None:
+            row = self.conn.execute(
+                "SELECT created, value FROM tavily_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[0] < self.ttl:
+                value = json.loads(row[1])
+                self._remember(key, row[0], value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        return None
+
+    def _store(self, key, value):
+        created = time.time()
+        with self.lock:
+            self._remember(key, created, value)
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO tavily_cache VALUES (?, ?, ?)",
+                    (key, created, json.dumps(value)),
+                )
+                self.conn.commit()
+
+    def _remember(self, key, created, value):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.coalesced + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "hit_rate": (
+                    (self.hits + self.coalesced) / requests if requests else 0.0
+                ),
+                "memory_entries": len(self.memory),
+            }
+
+
+def get_tavily_cache():
+    """Return a cache with the settings from the environment, or None when
+    TAVILY_CACHE_TTL is 0"""
+    if TAVILY_CACHE_TTL <= 0:
+        return None
+    return TavilyCache()
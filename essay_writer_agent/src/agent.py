@@ -7,10 +7,19 @@ from dotenv import load_dotenv
 
 _ = load_dotenv()
 
+import asyncio
+import contextvars
+import functools
 import operator
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Annotated, List, TypedDict
 
+import aiosqlite
+from checkpointer import BoundedMemorySaver
+from content_pipeline import select_content
+from content_store import CONTENT_STORE_PATH, ContentStore, add_ids
 from langchain_core.messages import (
     AIMessage,
     AnyMessage,
@@ -18,9 +27,13 @@ from langchain_core.messages import (
     HumanMessage,
     SystemMessage,
 )
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import END, StateGraph
+from llm_cache import get_llm_cache
 from prompts import (
     PLAN_PROMPT,
     REFLECTION_PROMPT,
@@ -29,7 +42,48 @@ from prompts import (
     WRITER_PROMPT,
 )
 from pydantic import BaseModel
-from tavily import TavilyClient
+from tavily import AsyncTavilyClient, TavilyClient
+from tavily_cache import get_tavily_cache
+from tracing import callbacks, span, traced
+
+# The searches of a node run concurrently on this pool, shared by all graph runs
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TAVILY_MAX_WORKERS", "16"))
+)
+# Request timeout of each search, in seconds, from when it starts rather than
+# when it is queued. Results of searches that time out are left out
+SEARCH_TIMEOUT = float(os.getenv("TAVILY_TIMEOUT", "30"))
+# Time a node waits for all its searches, in seconds, from when it starts them.
+# Searches still queued or running then are dropped. No deadline when 0
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "60"))
+# Search responses are reused across graph runs and threads
+tavily_cache = get_tavily_cache()
+# SQLite file for the graph checkpoints. In memory when empty
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "")
+
+
+def make_checkpointer(path=CHECKPOINT_DB):
+    """Return an SQLite checkpointer when path is set, so runs survive a restart,
+    or else a memory-bounded one"""
+    if path:
+        return SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+    # Old finished threads are evicted from memory above CHECKPOINT_MAX_BYTES
+    return BoundedMemorySaver()
+
+
+async def amake_checkpointer(path=CHECKPOINT_DB):
+    """make_checkpointer for graphs run with ainvoke or astream, as in the GUI: an
+    async SQLite checkpointer when path is set. Call it from the event loop that
+    runs the graph."""
+    if path:
+        return AsyncSqliteSaver(await aiosqlite.connect(path))
+    return make_checkpointer(path)
+
+
+def make_content_store(path=CHECKPOINT_DB):
+    """Return a store for the research content. It is kept in the checkpoint
+    file when there is one, so resumed runs find the content of their checkpoints"""
+    return ContentStore(path or CONTENT_STORE_PATH)
 
 
 class AgentState(TypedDict):
@@ -38,7 +92,8 @@ class AgentState(TypedDict):
     plan: str
     draft: str
     critique: str
-    content: List[str]
+    # IDs of the research snippets in the content store
+    content: Annotated[List[str], add_ids]
     queries: List[str]
     revision_number: int
     max_revisions: int
@@ -49,12 +104,52 @@ class Queries(BaseModel):
     queries: List[str]
 
 
+def results_content(response, search_span):
+    """Content of the results of a Tavily response, recorded on the search span"""
+    content = [r["content"] for r in response["results"]]
+    search_span.set(results=len(content), output_chars=sum(map(len, content)))
+    return content
+
+
+def searches_content(queries, searches, pending=()):
+    """Content of the finished searches (futures or tasks), in the order of the
+    queries. Failed searches, and the pending ones dropped at the deadline, are
+    skipped."""
+    content = []
+    for query, search in zip(queries, searches):
+        if search in pending:
+            print(f"Search dropped at the deadline of the node: {query}")
+        elif search.exception() is not None:
+            print(f"Search failed: {query}: {search.exception()}")
+        else:
+            content.extend(search.result())
+    return content
+
+
 class ewriter:
-    def __init__(self):
+    def __init__(self, checkpointer=None, content_store=None):
 
         # Initialize the model and the Tavily client
-        self.model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        # LLM calls are recorded or replayed depending on LLM_CACHE_MODE
+        # and traced when AGENT_TRACE is set
+        self.model = ChatOpenAI(
+            model="gpt-4o-mini",
+            temperature=0,
+            cache=get_llm_cache(),
+            callbacks=callbacks(),
+        )
         self.tavily = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+        self.atavily = AsyncTavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+        # Research text is stored once, the state holds its IDs. Checkpoints on
+        # disk need their content on disk too
+        if content_store is None:
+            if checkpointer is not None and not isinstance(checkpointer, MemorySaver):
+                raise ValueError(
+                    "pass the content store of the checkpoint file with a persistent"
+                    " checkpointer: content_store=make_content_store(path)"
+                )
+            content_store = make_content_store()
+        self.content_store = content_store
 
         # Define the prompts
         self.PLAN_PROMPT = PLAN_PROMPT
@@ -64,13 +159,28 @@ class ewriter:
         self.RESEARCH_CRITIQUE_PROMPT = RESEARCH_CRITIQUE_PROMPT
 
         # Create the graph
-        # Nodes
+        # Nodes. invoke and stream run the sync version, ainvoke and astream the async one
         builder = StateGraph(AgentState)
-        builder.add_node("planner", self.plan_node)
-        builder.add_node("research_plan", self.research_plan_node)
-        builder.add_node("generate", self.generation_node)
-        builder.add_node("reflect", self.reflection_node)
-        builder.add_node("research_critique", self.research_critique_node)
+        builder.add_node(
+            "planner", RunnableLambda(self.plan_node, afunc=self.aplan_node)
+        )
+        builder.add_node(
+            "research_plan",
+            RunnableLambda(self.research_plan_node, afunc=self.aresearch_plan_node),
+        )
+        builder.add_node(
+            "generate",
+            RunnableLambda(self.generation_node, afunc=self.ageneration_node),
+        )
+        builder.add_node(
+            "reflect", RunnableLambda(self.reflection_node, afunc=self.areflection_node)
+        )
+        builder.add_node(
+            "research_critique",
+            RunnableLambda(
+                self.research_critique_node, afunc=self.aresearch_critique_node
+            ),
+        )
         builder.set_entry_point("planner")
         # Edges
         builder.add_conditional_edges(
@@ -82,7 +192,8 @@ class ewriter:
         builder.add_edge("research_critique", "generate")
 
         # Compile graph with memory and interrupt states
-        checkpointer = MemorySaver()
+        if checkpointer is None:
+            checkpointer = make_checkpointer()
         self.graph = builder.compile(
             checkpointer=checkpointer,
             interrupt_after=[
@@ -93,33 +204,109 @@ class ewriter:
                 "research_critique",
             ],
         )
+        # Only the threads the graph has finished are evicted from memory
+        if isinstance(checkpointer, BoundedMemorySaver):
+            checkpointer.bind(self.graph)
 
-    # Node definitions
+    def search(self, query, max_results=2, timeout=SEARCH_TIMEOUT):
+        """Search the web with Tavily and return the content of the results"""
+        with span("tavily.search", "tool", input_chars=len(query)) as search_span:
+            search_fn = functools.partial(
+                self.tavily.search,
+                query=query,
+                max_results=max_results,
+                timeout=timeout,
+            )
+            if tavily_cache is not None:
+                response = tavily_cache.search(query, max_results, search_fn)
+            else:
+                response = search_fn()
+            return results_content(response, search_span)
 
-    def plan_node(self, state: AgentState):
-        messages = [
+    async def asearch(self, query, max_results=2, timeout=SEARCH_TIMEOUT):
+        """search with the async Tavily client"""
+        with span("tavily.search", "tool", input_chars=len(query)) as search_span:
+            search_fn = functools.partial(
+                self.atavily.search,
+                query=query,
+                max_results=max_results,
+                timeout=timeout,
+            )
+            if tavily_cache is not None:
+                response = await tavily_cache.asearch(query, max_results, search_fn)
+            else:
+                response = await search_fn()
+            return results_content(response, search_span)
+
+    def search_all(self, queries, timeout=SEARCH_TIMEOUT, deadline=SEARCH_DEADLINE):
+        """Run the searches concurrently and return the content of the results, in
+        the order of the queries. Failed and timed out searches are skipped.
+
+        The timeout applies to each search from when a worker starts it. The
+        deadline bounds the whole call: searches not done by then, including
+        those still waiting for a worker, are cancelled and skipped."""
+        futures = [
+            search_executor.submit(
+                contextvars.copy_context().run, self.search, q, timeout=timeout
+            )
+            for q in queries
+        ]
+        _, pending = wait(futures, timeout=deadline or None)
+        # A running search cannot be cancelled, it ends at its own timeout
+        for future in pending:
+            future.cancel()
+        return searches_content(queries, futures, pending)
+
+    async def asearch_all(
+        self, queries, timeout=SEARCH_TIMEOUT, deadline=SEARCH_DEADLINE
+    ):
+        """search_all on the event loop"""
+        tasks = [
+            asyncio.ensure_future(self.asearch(q, timeout=timeout)) for q in queries
+        ]
+        pending = set()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=deadline or None)
+        for task in pending:
+            task.cancel()
+        return searches_content(queries, tasks, pending)
+
+    # Node definitions. The messages and the state update of each node are built
+    # by its helpers, shared by the sync node and the async one used by ainvoke
+    # and astream. The async nodes run the content store, which blocks on SQLite,
+    # in a thread
+
+    def plan_messages(self, state):
+        return [
             SystemMessage(content=self.PLAN_PROMPT),
             HumanMessage(content=state["task"]),
         ]
-        response = self.model.invoke(messages)
+
+    def plan_update(self, response):
         return {
             "plan": response.content,
             "lnode": "planner",
             "count": 1,
         }
 
-    def research_plan_node(self, state: AgentState):
-        queries = self.model.with_structured_output(Queries).invoke(
-            [
-                SystemMessage(content=self.RESEARCH_PLAN_PROMPT),
-                HumanMessage(content=state["task"]),
-            ]
-        )
-        content = state["content"] or []  # add to content
-        for q in queries.queries:
-            response = self.tavily.search(query=q, max_results=2)
-            for r in response["results"]:
-                content.append(r["content"])
+    @traced("node.planner", "node")
+    def plan_node(self, state: AgentState):
+        response = self.model.invoke(self.plan_messages(state))
+        return self.plan_update(response)
+
+    @traced("node.planner", "node")
+    async def aplan_node(self, state: AgentState):
+        response = await self.model.ainvoke(self.plan_messages(state))
+        return self.plan_update(response)
+
+    def research_plan_messages(self, state):
+        return [
+            SystemMessage(content=self.RESEARCH_PLAN_PROMPT),
+            HumanMessage(content=state["task"]),
+        ]
+
+    def research_plan_update(self, queries, content):
+        # Only the IDs of the new content, the reducer appends them
         return {
             "content": content,
             "queries": queries.queries,
@@ -127,16 +314,40 @@ class ewriter:
             "count": 1,
         }
 
-    def generation_node(self, state: AgentState):
-        content = "\n\n".join(state["content"] or [])
+    @traced("node.research_plan", "node")
+    def research_plan_node(self, state: AgentState):
+        queries = self.model.with_structured_output(Queries).invoke(
+            self.research_plan_messages(state)
+        )
+        content = self.content_store.put(self.search_all(queries.queries))
+        return self.research_plan_update(queries, content)
+
+    @traced("node.research_plan", "node")
+    async def aresearch_plan_node(self, state: AgentState):
+        queries = await self.model.with_structured_output(Queries).ainvoke(
+            self.research_plan_messages(state)
+        )
+        content = await asyncio.to_thread(
+            self.content_store.put, await self.asearch_all(queries.queries)
+        )
+        return self.research_plan_update(queries, content)
+
+    def generation_messages(self, state, snippets):
+        # Only the research most relevant to the task, plan and critique, without
+        # duplicates, fits in the prompt
+        query = " ".join(
+            [state["task"], state.get("plan") or "", state.get("critique") or ""]
+        )
+        content = "\n\n".join(select_content(snippets, query))
         user_message = HumanMessage(
             content=f"{state['task']}\n\nHere is my plan:\n\n{state['plan']}"
         )
-        messages = [
+        return [
             SystemMessage(content=self.WRITER_PROMPT.format(content=content)),
             user_message,
         ]
-        response = self.model.invoke(messages)
+
+    def generation_update(self, state, response):
         return {
             "draft": response.content,
             "revision_number": state.get("revision_number", 1) + 1,
@@ -144,36 +355,72 @@ class ewriter:
             "count": 1,
         }
 
-    def reflection_node(self, state: AgentState):
-        messages = [
+    @traced("node.generate", "node")
+    def generation_node(self, state: AgentState):
+        snippets = self.content_store.get(state["content"])
+        response = self.model.invoke(self.generation_messages(state, snippets))
+        return self.generation_update(state, response)
+
+    @traced("node.generate", "node")
+    async def ageneration_node(self, state: AgentState):
+        snippets = await asyncio.to_thread(self.content_store.get, state["content"])
+        response = await self.model.ainvoke(self.generation_messages(state, snippets))
+        return self.generation_update(state, response)
+
+    def reflection_messages(self, state):
+        return [
             SystemMessage(content=self.REFLECTION_PROMPT),
             HumanMessage(content=state["draft"]),
         ]
-        response = self.model.invoke(messages)
+
+    def reflection_update(self, response):
         return {
             "critique": response.content,
             "lnode": "reflect",
             "count": 1,
         }
 
-    def research_critique_node(self, state: AgentState):
-        queries = self.model.with_structured_output(Queries).invoke(
-            [
-                SystemMessage(content=self.RESEARCH_CRITIQUE_PROMPT),
-                HumanMessage(content=state["critique"]),
-            ]
-        )
-        content = state["content"] or []
-        for q in queries.queries:
-            response = self.tavily.search(query=q, max_results=2)
-            for r in response["results"]:
-                content.append(r["content"])
+    @traced("node.reflect", "node")
+    def reflection_node(self, state: AgentState):
+        response = self.model.invoke(self.reflection_messages(state))
+        return self.reflection_update(response)
+
+    @traced("node.reflect", "node")
+    async def areflection_node(self, state: AgentState):
+        response = await self.model.ainvoke(self.reflection_messages(state))
+        return self.reflection_update(response)
+
+    def research_critique_messages(self, state):
+        return [
+            SystemMessage(content=self.RESEARCH_CRITIQUE_PROMPT),
+            HumanMessage(content=state["critique"]),
+        ]
+
+    def research_critique_update(self, content):
         return {
             "content": content,
             "lnode": "research_critique",
             "count": 1,
         }
 
+    @traced("node.research_critique", "node")
+    def research_critique_node(self, state: AgentState):
+        queries = self.model.with_structured_output(Queries).invoke(
+            self.research_critique_messages(state)
+        )
+        content = self.content_store.put(self.search_all(queries.queries))
+        return self.research_critique_update(content)
+
+    @traced("node.research_critique", "node")
+    async def aresearch_critique_node(self, state: AgentState):
+        queries = await self.model.with_structured_output(Queries).ainvoke(
+            self.research_critique_messages(state)
+        )
+        content = await asyncio.to_thread(
+            self.content_store.put, await self.asearch_all(queries.queries)
+        )
+        return self.research_critique_update(content)
+
     # Conditional edge definition
     def should_continue(self, state):
         if state["revision_number"] > state["max_revisions"]:
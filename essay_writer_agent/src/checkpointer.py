@@ -0,0 +1,304 @@
+""" In-memory checkpointer with bounded memory use, for long-running processes.
+
+MemorySaver keeps every checkpoint of every thread forever. BoundedMemorySaver
+- keeps at most max_checkpoints_per_thread checkpoints of each thread
+- keeps the checkpoints of all threads under max_bytes, by evicting the least
+  recently used finished threads: those with no next node to run in the graph
+  set with bind(). A thread that is paused or still running is never lost
+- spills evicted threads to an SQLite file when spill_path is set, and loads them
+  back transparently when they are used again; then unfinished threads are
+  spilled too if needed. Otherwise evicted threads are lost, and memory goes over
+  max_bytes when only unfinished threads are left.
+"""
+
+import contextvars
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+
+from langgraph.checkpoint.memory import MemorySaver
+
+CHECKPOINT_MAX_PER_THREAD = int(os.getenv("CHECKPOINT_MAX_PER_THREAD", "0"))
+CHECKPOINT_MAX_BYTES = int(os.getenv("CHECKPOINT_MAX_BYTES", str(512 * 1024 * 1024)))
+CHECKPOINT_SPILL_PATH = os.getenv("CHECKPOINT_SPILL_PATH", "")
+
+
+class BoundedMemorySaver(MemorySaver):
+    """MemorySaver with caps on checkpoints per thread (0 for no cap) and on total bytes"""
+
+    def __init__(
+        self,
+        max_checkpoints_per_thread=CHECKPOINT_MAX_PER_THREAD,
+        max_bytes=CHECKPOINT_MAX_BYTES,
+        spill_path=CHECKPOINT_SPILL_PATH,
+        *,
+        serde=None,
+    ):
+        super().__init__(serde=serde)
+        self.max_checkpoints_per_thread = max_checkpoints_per_thread
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        # Threads in memory, least recently used first
+        self.last_used = OrderedDict()
+        self.thread_bytes = {}
+        self.total_bytes = 0
+        # Keys of each thread in self.writes and self.blobs, and the channel
+        # versions of each checkpoint, so a thread is pruned without a full scan
+        self.write_keys = defaultdict(set)
+        self.blob_keys = defaultdict(set)
+        self.versions = defaultdict(dict)
+        self.spilled = set()
+        self.evictions = 0
+        self.spills = 0
+        self.restores = 0
+        self.pruned_checkpoints = 0
+        self.graph = None
+        # Whether each thread is finished, until its next checkpoint or write
+        self.finished = {}
+        self.spill = None
+        if spill_path:
+            self.spill = sqlite3.connect(spill_path, check_same_thread=False)
+            self.spill.execute(
+                "CREATE TABLE IF NOT EXISTS spill (thread_id TEXT PRIMARY KEY, data BLOB)"
+            )
+            # Spilled threads only extend memory, they do not outlive the process
+            self.spill.execute("DELETE FROM spill")
+            self.spill.commit()
+
+    def bind(self, graph):
+        """Set the compiled graph that runs the threads, to tell which threads are
+        finished. Until then, no thread is dropped, only spilled"""
+        self.graph = graph
+
+    def get_tuple(self, config):
+        with self.lock:
+            self._touch(config["configurable"]["thread_id"])
+            return super().get_tuple(config)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        # Listing without a thread only covers the threads in memory
+        with self.lock:
+            if config:
+                self._touch(config["configurable"]["thread_id"])
+            return iter(
+                list(super().list(config, filter=filter, before=before, limit=limit))
+            )
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self.lock:
+            self._touch(thread_id)
+            self.finished.pop(thread_id, None)
+            result = super().put(config, checkpoint, metadata, new_versions)
+            self.last_used[thread_id] = None
+            self.last_used.move_to_end(thread_id)
+            self.versions[thread_id][(checkpoint_ns, checkpoint["id"])] = dict(
+                checkpoint["channel_versions"]
+            )
+            for channel, version in new_versions.items():
+                self.blob_keys[thread_id].add(
+                    (thread_id, checkpoint_ns, channel, version)
+                )
+            self._prune(thread_id, checkpoint_ns)
+            self._account(thread_id)
+            self._evict(keep=thread_id)
+            return result
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            self._touch(thread_id)
+            self.finished.pop(thread_id, None)
+            super().put_writes(config, writes, task_id, task_path)
+            self.write_keys[thread_id].add(
+                (
+                    thread_id,
+                    config["configurable"].get("checkpoint_ns", ""),
+                    config["configurable"]["checkpoint_id"],
+                )
+            )
+            if thread_id in self.last_used:
+                self._account(thread_id)
+                self._evict(keep=thread_id)
+
+    def delete_thread(self, thread_id):
+        with self.lock:
+            self._drop(thread_id)
+            if thread_id in self.spilled:
+                self.spilled.discard(thread_id)
+                self.spill.execute(
+                    "DELETE FROM spill WHERE thread_id = ?", (thread_id,)
+                )
+                self.spill.commit()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "threads": len(self.last_used),
+                "spilled_threads": len(self.spilled),
+                "checkpoints": sum(map(len, self.versions.values())),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "spills": self.spills,
+                "restores": self.restores,
+                "pruned_checkpoints": self.pruned_checkpoints,
+            }
+
+    def _touch(self, thread_id):
+        if thread_id in self.spilled:
+            self._restore(thread_id)
+        if thread_id in self.last_used:
+            self.last_used.move_to_end(thread_id)
+
+    def _account(self, thread_id):
+        """Recompute the serialized size of a thread"""
+        size = sum(
+            len(checkpoint[1]) + len(metadata[1])
+            for checkpoints in self.storage.get(thread_id, {}).values()
+            for checkpoint, metadata, _ in checkpoints.values()
+        )
+        size += sum(
+            len(write[2][1])
+            for key in self.write_keys[thread_id]
+            for write in self.writes.get(key, {}).values()
+        )
+        size += sum(len(self.blobs[key][1]) for key in self.blob_keys[thread_id])
+        self.total_bytes += size - self.thread_bytes.get(thread_id, 0)
+        self.thread_bytes[thread_id] = size
+
+    def _prune(self, thread_id, checkpoint_ns):
+        """Delete the oldest checkpoints of a thread above the cap, and the channel
+        values that no remaining checkpoint uses"""
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if not self.max_checkpoints_per_thread:
+            return
+        excess = len(checkpoints) - self.max_checkpoints_per_thread
+        if excess <= 0:
+            return
+        for checkpoint_id in sorted(checkpoints)[:excess]:
+            del checkpoints[checkpoint_id]
+            key = (thread_id, checkpoint_ns, checkpoint_id)
+            self.writes.pop(key, None)
+            self.write_keys[thread_id].discard(key)
+            self.versions[thread_id].pop((checkpoint_ns, checkpoint_id), None)
+            self.pruned_checkpoints += 1
+        used = {
+            (thread_id, checkpoint_ns, channel, version)
+            for checkpoint_id in checkpoints
+            for channel, version in self.versions[thread_id]
+            .get((checkpoint_ns, checkpoint_id), {})
+            .items()
+        }
+        for key in [
+            k
+            for k in self.blob_keys[thread_id]
+            if k[1] == checkpoint_ns and k not in used
+        ]:
+            self.blobs.pop(key, None)
+            self.blob_keys[thread_id].discard(key)
+
+    def _evict(self, keep):
+        """Evict the least recently used finished threads, except keep, until under
+        max_bytes. With a spill file, then spill the unfinished ones"""
+        if self.total_bytes <= self.max_bytes:
+            return
+        unfinished = []
+        # is_finished reads the state of the thread, which moves it in last_used
+        for thread_id in [t for t in self.last_used if t != keep]:
+            if self.total_bytes <= self.max_bytes:
+                return
+            if self.is_finished(thread_id):
+                self._evict_thread(thread_id)
+            else:
+                unfinished.append(thread_id)
+        if self.spill is None:
+            return
+        for thread_id in unfinished:
+            if self.total_bytes <= self.max_bytes:
+                return
+            self._evict_thread(thread_id)
+
+    def is_finished(self, thread_id):
+        """Whether the latest checkpoint of a thread has no pending writes and no
+        next node to run"""
+        if self.graph is None:
+            return False
+        if thread_id not in self.finished:
+            checkpoints = self.storage.get(thread_id, {}).get("", {})
+            # Writes are saved while a step runs, before its checkpoint
+            if not checkpoints or self.writes.get((thread_id, "", max(checkpoints))):
+                return False
+            # In an empty context, so the config of the run calling put is not merged in
+            state = contextvars.Context().run(
+                self.graph.get_state, {"configurable": {"thread_id": thread_id}}
+            )
+            self.finished[thread_id] = not state.next
+        return self.finished[thread_id]
+
+    def _evict_thread(self, thread_id):
+        if self.spill is not None:
+            self._spill(thread_id)
+        self._drop(thread_id)
+        self.evictions += 1
+
+    def _thread_data(self, thread_id):
+        return {
+            "storage": {
+                ns: dict(checkpoints)
+                for ns, checkpoints in self.storage.get(thread_id, {}).items()
+            },
+            "writes": {
+                key: self.writes[key]
+                for key in self.write_keys[thread_id]
+                if key in self.writes
+            },
+            "blobs": {key: self.blobs[key] for key in self.blob_keys[thread_id]},
+            "versions": self.versions[thread_id],
+        }
+
+    def _spill(self, thread_id):
+        data = pickle.dumps(self._thread_data(thread_id))
+        self.spill.execute(
+            "INSERT OR REPLACE INTO spill VALUES (?, ?)", (thread_id, data)
+        )
+        self.spill.commit()
+        self.spilled.add(thread_id)
+        self.spills += 1
+
+    def _restore(self, thread_id):
+        row = self.spill.execute(
+            "SELECT data FROM spill WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+        self.spill.execute("DELETE FROM spill WHERE thread_id = ?", (thread_id,))
+        self.spill.commit()
+        self.spilled.discard(thread_id)
+        data = pickle.loads(row[0])
+        for ns, checkpoints in data["storage"].items():
+            self.storage[thread_id][ns].update(checkpoints)
+        for key, writes in data["writes"].items():
+            self.writes[key] = writes
+            self.write_keys[thread_id].add(key)
+        for key, blob in data["blobs"].items():
+            self.blobs[key] = blob
+            self.blob_keys[thread_id].add(key)
+        self.versions[thread_id].update(data["versions"])
+        self.last_used[thread_id] = None
+        self._account(thread_id)
+        self.restores += 1
+        self._evict(keep=thread_id)
+
+    def _drop(self, thread_id):
+        """Remove a thread from memory"""
+        self.storage.pop(thread_id, None)
+        for key in self.write_keys.pop(thread_id, ()):
+            self.writes.pop(key, None)
+        for key in self.blob_keys.pop(thread_id, ()):
+            self.blobs.pop(key, None)
+        self.versions.pop(thread_id, None)
+        self.finished.pop(thread_id, None)
+        self.total_bytes -= self.thread_bytes.pop(thread_id, 0)
+        self.last_used.pop(thread_id, None)
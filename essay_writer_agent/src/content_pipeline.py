@@ -0,0 +1,98 @@
+""" Selection of the research content passed to the writer.
+
+The content collected by the search nodes grows with every revision and holds
+duplicates. select_content removes exact and near-duplicate snippets, ranks the
+rest by BM25 relevance to a query (the task, plan or critique) and keeps the
+best ones that fit in a token budget.
+"""
+
+import math
+import os
+import re
+from collections import Counter
+
+CONTENT_MAX_TOKENS = int(os.getenv("CONTENT_MAX_TOKENS", "6000"))
+# Snippets sharing at least this fraction of their word trigrams are duplicates
+CONTENT_NEAR_DUPLICATE = float(os.getenv("CONTENT_NEAR_DUPLICATE", "0.8"))
+# Placeholders that are not research
+PLACEHOLDERS = {"", "no content"}
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def estimate_tokens(text):
+    """Rough token count, about 4 characters per token"""
+    return len(text) // 4 + 1
+
+
+def shingles(words, size=3):
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def deduplicate(snippets, threshold=CONTENT_NEAR_DUPLICATE):
+    """Drop placeholders, exact duplicates (ignoring case and whitespace) and
+    snippets too similar to an earlier one. Keeps the first occurrence."""
+    kept = []
+    seen = set()
+    kept_shingles = []
+    for snippet in snippets:
+        words = tokenize(snippet)
+        key = " ".join(words)
+        if key in PLACEHOLDERS or key in seen:
+            continue
+        seen.add(key)
+        grams = shingles(words)
+        if any(
+            len(grams & other) / len(grams | other) >= threshold
+            for other in kept_shingles
+        ):
+            continue
+        kept.append(snippet)
+        kept_shingles.append(grams)
+    return kept
+
+
+def bm25_scores(query, documents, k1=1.5, b=0.75):
+    """Okapi BM25 score of each document for the query"""
+    docs = [Counter(tokenize(document)) for document in documents]
+    if not docs:
+        return []
+    avg_length = sum(sum(doc.values()) for doc in docs) / len(docs) or 1
+    document_frequency = Counter(term for doc in docs for term in doc)
+    idf = {
+        term: math.log(1 + (len(docs) - n + 0.5) / (n + 0.5))
+        for term, n in document_frequency.items()
+    }
+    terms = set(tokenize(query))
+    scores = []
+    for doc in docs:
+        norm = k1 * (1 - b + b * sum(doc.values()) / avg_length)
+        scores.append(
+            sum(
+                idf[term] * doc[term] * (k1 + 1) / (doc[term] + norm)
+                for term in terms
+                if term in doc
+            )
+        )
+    return scores
+
+
+def select_content(snippets, query, max_tokens=CONTENT_MAX_TOKENS):
+    """Return the deduplicated snippets most relevant to the query that fit in
+    max_tokens, best first"""
+    snippets = deduplicate(snippets or [])
+    scores = bm25_scores(query, snippets)
+    ranked = sorted(range(len(snippets)), key=lambda i: -scores[i])
+    selected = []
+    used = 0
+    for i in ranked:
+        size = estimate_tokens(snippets[i])
+        if used + size > max_tokens:
+            continue
+        selected.append(snippets[i])
+        used += size
+    return selected
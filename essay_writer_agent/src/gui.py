@@ -7,28 +7,186 @@ from dotenv import load_dotenv
 
 _ = load_dotenv()
 
+import itertools
 import os
+import threading
+from collections import OrderedDict
 
 import gradio as gr
 
+# Nodes whose model output is text written to the state, streamed token by token.
+# The others ask for structured output, whose tokens are JSON
+STREAMED_NODES = {"planner", "generate", "reflect"}
+# Checkpoints listed per page of the step pulldown
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "25"))
+# Threads kept in the history index, least recently used dropped first
+HISTORY_MAX_THREADS = int(os.getenv("HISTORY_MAX_THREADS", "256"))
+HISTORY_LABEL = "update_state from: thread:count:last_node:next_node:rev:checkpoint_id"
+# Checkpoints shown per page of the snapshot viewer, and characters shown of a text
+SNAPSHOT_PAGE_SIZE = int(os.getenv("SNAPSHOT_PAGE_SIZE", "10"))
+SNAPSHOT_TEXT_CHARS = 80
+# Agent runs at the same time across all sessions, and runs waiting for their turn
+GUI_MAX_RUNS = int(os.getenv("GUI_MAX_RUNS", "8"))
+GUI_QUEUE_SIZE = int(os.getenv("GUI_QUEUE_SIZE", "64"))
+
+
+class WriterSession:
+    """What one browser session is working on. Gradio keeps a copy per session"""
+
+    def __init__(self):
+        self.partial_message = ""
+        self.iterations = {}
+        self.threads = []
+        self.thread_id = -1
+
+    @property
+    def thread(self):
+        return {"configurable": {"thread_id": str(self.thread_id)}}
+
+
+class HistoryIndex:
+    """Checkpoints of the most recently used threads, newest first, with their
+    pulldown labels and configs. refresh only reads the checkpoints written since
+    the last call, by following the parents of the latest one to a known
+    checkpoint, and forgets the oldest ones that the checkpointer no longer keeps."""
+
+    def __init__(
+        self, graph, page_size=HISTORY_PAGE_SIZE, max_threads=HISTORY_MAX_THREADS
+    ):
+        self.graph = graph
+        self.page_size = page_size
+        self.max_threads = max_threads
+        self.lock = threading.Lock()
+        # (checkpoint_id, label) of each thread, newest first, early states
+        # included without a label. Least recently used thread first
+        self.entries = OrderedDict()
+        self.configs = {}
+
+    def refresh(self, thread):
+        thread_id = thread["configurable"]["thread_id"]
+        with self.lock:
+            entries = self.entries.pop(thread_id, [])
+            configs = self.configs.pop(thread_id, {})
+            # The checkpointer prunes the oldest checkpoints and evicts whole threads
+            while (
+                entries
+                and self.graph.get_state(configs[entries[-1][0]]).metadata is None
+            ):
+                del configs[entries.pop()[0]]
+            new = []
+            state = self.graph.get_state(thread)
+            while state.metadata is not None:
+                checkpoint_id = state.config["configurable"]["checkpoint_id"]
+                if checkpoint_id in configs:
+                    break
+                configs[checkpoint_id] = state.config
+                # ignore early states
+                label = self.label(state) if state.metadata["step"] >= 1 else None
+                new.append((checkpoint_id, label))
+                if state.parent_config is None:
+                    break
+                state = self.graph.get_state(state.parent_config)
+            # Checkpoint IDs increase with time, so new checkpoints come first
+            self.entries[thread_id] = new + entries
+            self.configs[thread_id] = configs
+            while len(self.entries) > self.max_threads:
+                old_thread_id, _ = self.entries.popitem(last=False)
+                del self.configs[old_thread_id]
+
+    @staticmethod
+    def label(state):
+        tid = state.config["configurable"]["thread_id"]
+        checkpoint_id = state.config["configurable"]["checkpoint_id"]
+        count = state.values["count"]
+        lnode = state.values["lnode"]
+        rev = state.values["revision_number"]
+        nnode = state.next
+        return f"{tid}:{count}:{lnode}:{nnode}:{rev}:{checkpoint_id}"
+
+    def find_config(self, thread, checkpoint_id):
+        thread_id = thread["configurable"]["thread_id"]
+        with self.lock:
+            return self.configs.get(thread_id, {}).get(checkpoint_id)
+
+    def labels(self, thread_id):
+        with self.lock:
+            return [label for _, label in self.entries.get(str(thread_id), []) if label]
+
+    def pages(self, thread_id):
+        return max(1, -(-len(self.labels(thread_id)) // self.page_size))
+
+    def page(self, thread_id, page=1):
+        """Labels of a page of the thread's checkpoints, pages start at 1"""
+        start = (page - 1) * self.page_size
+        return self.labels(thread_id)[start : start + self.page_size]
+
+    def snapshot_ids(self, thread, page=1, page_size=SNAPSHOT_PAGE_SIZE):
+        """Checkpoint IDs of a page of the thread's snapshots, and the number of pages"""
+        thread_id = thread["configurable"]["thread_id"]
+        self.refresh(thread)
+        with self.lock:
+            ids = [checkpoint_id for checkpoint_id, _ in self.entries[thread_id]]
+        pages = max(1, -(-len(ids) // page_size))
+        page = min(max(int(page or 1), 1), pages)
+        return ids[(page - 1) * page_size : page * page_size], page, pages
+
+    def dropdown(self, thread, page=1):
+        thread_id = thread["configurable"]["thread_id"]
+        self.refresh(thread)
+        page = min(max(int(page or 1), 1), self.pages(thread_id))
+        choices = self.page(thread_id, page)
+        return gr.Dropdown(
+            label=f"{HISTORY_LABEL} (page {page}/{self.pages(thread_id)})",
+            choices=choices,
+            value=choices[0] if choices else None,
+            interactive=True,
+        )
+
+
+def short(value, chars=SNAPSHOT_TEXT_CHARS):
+    text = str(value).replace("\n", " ")
+    if len(text) <= chars:
+        return repr(text) if isinstance(value, str) else text
+    return f"{text[:chars]!r}... ({len(text)} chars)"
+
+
+def diff_values(old, new):
+    """One line per key whose value differs between two states"""
+    lines = []
+    for key in new:
+        if key in old and old[key] == new[key]:
+            continue
+        before, after = old.get(key), new[key]
+        if isinstance(after, list) and isinstance(before, list):
+            added = [item for item in after if item not in before]
+            removed = len(before) - (len(after) - len(added))
+            lines.append(
+                f"  {key}: +{len(added)} -{removed} items ({len(after)} total)"
+            )
+        elif isinstance(after, str) and len(after) > SNAPSHOT_TEXT_CHARS:
+            lines.append(f"  {key}: {short(after)}")
+        else:
+            lines.append(f"  {key}: {short(before)} -> {short(after)}")
+    return lines
+
 
 class writer_gui:
-    def __init__(self, graph, share=False):
+    def __init__(self, graph, share=False, content_store=None):
         self.graph = graph
+        # Store of the research text when the state only holds its IDs
+        self.content_store = content_store
         self.share = share
-        self.partial_message = ""
-        self.response = {}
         self.max_iterations = 10
-        self.iterations = []
-        self.threads = []
-        self.thread_id = -1
-        self.thread = {"configurable": {"thread_id": str(self.thread_id)}}
+        # Thread IDs are unique across sessions
+        self.thread_ids = itertools.count()
+        self.history = HistoryIndex(graph)
         self.demo = self.create_interface()
 
-    def run_agent(self, start, topic, stop_after):
-        """run the agent. If start is True, this is a new agent. If start is False, this is a continuation of an existing agent."""
+    async def run_agent(self, session, start, topic, stop_after):
+        """run the agent. If start is True, this is a new agent. If start is False, this is a continuation of an existing agent.
+        Runs on the event loop, so a run waiting for the model does not hold a thread.
+        """
         if start:
-            self.iterations.append(0)
             config = {
                 "task": topic,
                 "max_revisions": 2,
@@ -37,25 +195,50 @@ class writer_gui:
                 "planner": "no plan",
                 "draft": "no draft",
                 "critique": "no critique",
-                "content": [
-                    "no content",
-                ],
+                "content": [],
                 "queries": "no queries",
                 "count": 0,
             }
-            self.thread_id += 1  # new agent, new thread
-            self.threads.append(self.thread_id)
+            session.thread_id = next(self.thread_ids)  # new agent, new thread
+            session.threads.append(session.thread_id)
+            session.iterations[session.thread_id] = 0
         else:
             config = None
-        self.thread = {"configurable": {"thread_id": str(self.thread_id)}}
-        while self.iterations[self.thread_id] < self.max_iterations:
-            self.response = self.graph.invoke(config, self.thread)
-            self.iterations[self.thread_id] += 1
-            self.partial_message += str(self.response)
-            self.partial_message += f"\n------------------\n\n"
-
-            lnode, nnode, _, rev, acount = self.get_disp_state()
-            yield self.partial_message, lnode, nnode, self.thread_id, rev, acount
+        thread = session.thread
+        while session.iterations.get(session.thread_id, 0) < self.max_iterations:
+            # Tokens of the text written by the model are shown as they arrive,
+            # the other nodes are summarized when they finish
+            streaming = None
+            async for mode, chunk in self.graph.astream(
+                config, thread, stream_mode=["messages", "updates"]
+            ):
+                if mode == "messages":
+                    message, metadata = chunk
+                    node = metadata.get("langgraph_node")
+                    if node not in STREAMED_NODES or not message.content:
+                        continue
+                    if node != streaming:
+                        streaming = node
+                        session.partial_message += f"{node}:\n"
+                    session.partial_message += message.content
+                    yield session.partial_message
+                    continue
+                for node, update in chunk.items():
+                    if node == "__interrupt__":
+                        continue
+                    if node in STREAMED_NODES:
+                        session.partial_message += "\n"
+                    else:
+                        session.partial_message += self.summarize_update(node, update)
+                    session.partial_message += f"\n------------------\n\n"
+                    yield session.partial_message
+            session.iterations[session.thread_id] = (
+                session.iterations.get(session.thread_id, 0) + 1
+            )
+
+            current_state = await self.graph.aget_state(thread)
+            lnode = current_state.values["lnode"]
+            nnode = current_state.next
             config = None  # need
             # print(f"run_agent:{lnode}")
             if not nnode:
@@ -69,84 +252,84 @@ class writer_gui:
                 pass
         return
 
-    def get_disp_state(
-        self,
-    ):
-        current_state = self.graph.get_state(self.thread)
+    def summarize_update(self, node, update):
+        """One line per value written by a node whose output is not streamed"""
+        lines = [f"{node}:"]
+        for key, value in (update or {}).items():
+            if key in ("lnode", "count"):
+                continue
+            if key == "content":
+                value = f"{len(value)} research snippets"
+            elif isinstance(value, list):
+                value = "; ".join(map(str, value))
+            lines.append(f"{key}: {value}")
+        return "\n".join(lines) + "\n"
+
+    def get_disp_state(self, session):
+        current_state = self.graph.get_state(session.thread)
         lnode = current_state.values["lnode"]
         acount = current_state.values["count"]
         rev = current_state.values["revision_number"]
         nnode = current_state.next
 
-        return lnode, nnode, self.thread_id, rev, acount
+        return lnode, nnode, session.thread_id, rev, acount
 
-    def get_state(self, key):
-        current_values = self.graph.get_state(self.thread)
+    def get_state(self, session, key):
+        current_values = self.graph.get_state(session.thread)
         if key in current_values.values:
-            lnode, nnode, self.thread_id, rev, astep = self.get_disp_state()
-            new_label = f"last_node: {lnode}, thread_id: {self.thread_id}, rev: {rev}, step: {astep}"
+            lnode, nnode, thread_id, rev, astep = self.get_disp_state(session)
+            new_label = (
+                f"last_node: {lnode}, thread_id: {thread_id}, rev: {rev}, step: {astep}"
+            )
             return gr.update(label=new_label, value=current_values.values[key])
         else:
             return ""
 
-    def get_content(
-        self,
-    ):
-        current_values = self.graph.get_state(self.thread)
+    def resolve_content(self, content):
+        """Return the research text of the content IDs of a state"""
+        if self.content_store is None:
+            return content or []
+        return self.content_store.get(content)
+
+    def get_content(self, session):
+        current_values = self.graph.get_state(session.thread)
         if "content" in current_values.values:
-            content = current_values.values["content"]
-            lnode, nnode, thread_id, rev, astep = self.get_disp_state()
-            new_label = f"last_node: {lnode}, thread_id: {self.thread_id}, rev: {rev}, step: {astep}"
+            content = self.resolve_content(current_values.values["content"])
+            lnode, nnode, thread_id, rev, astep = self.get_disp_state(session)
+            new_label = (
+                f"last_node: {lnode}, thread_id: {thread_id}, rev: {rev}, step: {astep}"
+            )
             return gr.update(
                 label=new_label, value="\n\n".join(item for item in content) + "\n\n"
             )
         else:
             return ""
 
-    def update_hist_pd(
-        self,
-    ):
+    def update_hist_pd(self, session, page=1):
         """update the state pulldown"""
-        hist = []
-        # this generator returns the latest first
-        for state in self.graph.get_state_history(self.thread):
-            if state.metadata["step"] < 1:
-                continue
-            checkpoint_id = state.config["configurable"]["checkpoint_id"]
-            tid = state.config["configurable"]["thread_id"]
-            count = state.values["count"]
-            lnode = state.values["lnode"]
-            rev = state.values["revision_number"]
-            nnode = state.next
-            st = f"{tid}:{count}:{lnode}:{nnode}:{rev}:{checkpoint_id}"
-            hist.append(st)
-        return gr.Dropdown(
-            label="update_state from: thread:count:last_node:next_node:rev:checkpoint_id",
-            choices=hist,
-            value=hist[0],
-            interactive=True,
-        )
+        return self.history.dropdown(session.thread, page)
 
-    def find_config(self, checkpoint_id):
+    def find_config(self, session, checkpoint_id):
         """find the config for a given checkpoint_id"""
-        for state in self.graph.get_state_history(self.thread):
-            config = state.config
-            if config["configurable"]["checkpoint_id"] == checkpoint_id:
-                return config
-        return None
+        self.history.refresh(session.thread)
+        return self.history.find_config(session.thread, checkpoint_id)
 
-    def copy_state(self, hist_str):
+    def copy_state(self, session, hist_str):
         """result of selecting an old state from the step pulldown. Note does not change thread.
         This copies an old state to a new current state.
         """
         checkpoint_id = hist_str.split(":")[-1]
 
-        config = self.find_config(checkpoint_id)
+        config = self.find_config(session, checkpoint_id)
+        if config is None:
+            # Pruned by the checkpointer since the pulldown was filled
+            gr.Warning(f"checkpoint {checkpoint_id} no longer available")
+            return
         state = self.graph.get_state(config)
-        self.graph.update_state(
-            self.thread, state.values, as_node=state.values["lnode"]
-        )
-        new_state = self.graph.get_state(self.thread)  # should now match
+        # Update from the old checkpoint: content only ever appends IDs, so it
+        # would keep the newer research if the update was applied to the current one
+        self.graph.update_state(config, state.values, as_node=state.values["lnode"])
+        new_state = self.graph.get_state(session.thread)  # should now match
         new_checkpoint_id = new_state.config["configurable"]["checkpoint_id"]
         tid = new_state.config["configurable"]["thread_id"]
         count = new_state.values["count"]
@@ -155,31 +338,58 @@ class writer_gui:
         nnode = new_state.next
         return lnode, nnode, new_checkpoint_id, rev, count
 
-    def update_thread_pd(
-        self,
-    ):
+    def get_snapshots(self, session, page=1):
+        """A page of the thread's checkpoints, newest first, each with the values it
+        changed from its parent. Only the checkpoints of the page are loaded."""
+        ids, page, pages = self.history.snapshot_ids(session.thread, page)
+        new_label = f"thread_id: {session.thread_id}, changes of each snapshot (page {page}/{pages})"
+        sstate = ""
+        for checkpoint_id in ids:
+            config = self.history.find_config(session.thread, checkpoint_id)
+            if config is None:
+                sstate += f"{checkpoint_id}\n  checkpoint no longer available\n\n"
+                continue
+            state = self.graph.get_state(config)
+            parent = (
+                self.graph.get_state(state.parent_config)
+                if state.parent_config is not None
+                else None
+            )
+            metadata = state.metadata or {}
+            sstate += (
+                f"step {metadata.get('step')} ({metadata.get('source')}) {checkpoint_id}"
+                f" next: {state.next}\n"
+            )
+            if parent is not None and parent.metadata is None:
+                sstate += "  parent checkpoint no longer kept"
+            else:
+                changes = diff_values(parent.values if parent else {}, state.values)
+                sstate += "\n".join(changes or ["  no changes"])
+            sstate += "\n\n"
+        return gr.update(label=new_label, value=sstate)
+
+    def update_thread_pd(self, session):
         """update the thread pulldown"""
         return gr.Dropdown(
             label="choose thread",
-            choices=self.threads,
-            value=self.thread_id,
+            choices=session.threads,
+            value=session.thread_id,
             interactive=True,
         )
 
-    def switch_thread(self, new_thread_id):
+    def switch_thread(self, session, new_thread_id):
         """switch to a new thread. This will create a new 'current state' node."""
-        self.thread = {"configurable": {"thread_id": str(new_thread_id)}}
-        self.thread_id = new_thread_id
+        session.thread_id = new_thread_id
         return
 
-    def modify_state(self, key, asnode, new_state):
+    def modify_state(self, session, key, asnode, new_state):
         """gets the current state, modifes a single value in the state identified by key, and updates state with it.
         note that this will create a new 'current state' node. If you do this multiple times with different keys, it will create
         one for each update. Note also that it doesn't resume after the update
         """
-        current_values = self.graph.get_state(self.thread)
+        current_values = self.graph.get_state(session.thread)
         current_values.values[key] = new_state
-        self.graph.update_state(self.thread, current_values.values, as_node=asnode)
+        self.graph.update_state(session.thread, current_values.values, as_node=asnode)
         return
 
     def create_interface(self):
@@ -187,24 +397,11 @@ class writer_gui:
             theme=gr.themes.Default(spacing_size="sm", text_size="sm")
         ) as demo:
 
-            def updt_disp():
-                """general update display on state change"""
-                current_state = self.graph.get_state(self.thread)
-                hist = []
-                # curiously, this generator returns the latest first
-                for state in self.graph.get_state_history(self.thread):
-                    if state.metadata["step"] < 1:  # ignore early states
-                        continue
-                    s_checkpoint_id = state.config["configurable"]["checkpoint_id"]
-
-                    s_tid = state.config["configurable"]["thread_id"]
-                    s_count = state.values["count"]
-                    s_lnode = state.values["lnode"]
-                    s_rev = state.values["revision_number"]
-                    s_nnode = state.next
-                    st = f"{s_tid}:{s_count}:{s_lnode}:{s_nnode}:{s_rev}:{s_checkpoint_id}"
+            session = gr.State(WriterSession())
 
-                    hist.append(st)
+            def updt_disp(session):
+                """general update display on state change"""
+                current_state = self.graph.get_state(session.thread)
                 if not current_state.metadata:  # handle init call
                     return {}
                 else:
@@ -214,38 +411,12 @@ class writer_gui:
                         count_bx: current_state.values["count"],
                         revision_bx: current_state.values["revision_number"],
                         nnode_bx: current_state.next,
-                        threadid_bx: self.thread_id,
-                        thread_pd: gr.Dropdown(
-                            label="choose thread",
-                            choices=self.threads,
-                            value=self.thread_id,
-                            interactive=True,
-                        ),
-                        step_pd: gr.Dropdown(
-                            label="update_state from: thread:count:last_node:next_node:rev:checkpoint_id",
-                            choices=hist,
-                            value=hist[0],
-                            interactive=True,
-                        ),
+                        threadid_bx: session.thread_id,
+                        thread_pd: self.update_thread_pd(session),
+                        step_pd: self.history.dropdown(session.thread),
+                        page_nb: 1,
                     }
 
-            def get_snapshots():
-                new_label = f"thread_id: {self.thread_id}, Summary of snapshots"
-                sstate = ""
-                for state in self.graph.get_state_history(self.thread):
-                    for key in ["plan", "draft", "critique"]:
-                        if key in state.values:
-                            state.values[key] = state.values[key][:80] + "..."
-                    if "content" in state.values:
-                        for i in range(len(state.values["content"])):
-                            state.values["content"][i] = (
-                                state.values["content"][i][:20] + "..."
-                            )
-                    if "writes" in state.metadata:
-                        state.metadata["writes"] = "not shown"
-                    sstate += str(state) + "\n\n"
-                return gr.update(label=new_label, value=sstate)
-
             def vary_btn(stat):
                 return gr.update(variant=stat)
 
@@ -274,7 +445,7 @@ class writer_gui:
                     )
                     with gr.Row():
                         thread_pd = gr.Dropdown(
-                            choices=self.threads,
+                            choices=[],
                             interactive=True,
                             label="select thread",
                             min_width=120,
@@ -287,6 +458,14 @@ class writer_gui:
                             min_width=160,
                             scale=1,
                         )
+                        page_nb = gr.Number(
+                            value=1,
+                            minimum=1,
+                            precision=0,
+                            label="step page",
+                            min_width=80,
+                            scale=0,
+                        )
                 live = gr.Textbox(label="Live Agent Output", lines=5, max_lines=5)
 
                 # actions
@@ -299,22 +478,32 @@ class writer_gui:
                     count_bx,
                     step_pd,
                     thread_pd,
+                    page_nb,
                 ]
-                thread_pd.input(self.switch_thread, [thread_pd], None).then(
-                    fn=updt_disp, inputs=None, outputs=sdisps
+                thread_pd.input(self.switch_thread, [session, thread_pd], None).then(
+                    fn=updt_disp, inputs=session, outputs=sdisps
                 )
-                step_pd.input(self.copy_state, [step_pd], None).then(
-                    fn=updt_disp, inputs=None, outputs=sdisps
+                step_pd.input(self.copy_state, [session, step_pd], None).then(
+                    fn=updt_disp, inputs=session, outputs=sdisps
                 )
+                page_nb.input(self.update_hist_pd, [session, page_nb], step_pd)
                 gen_btn.click(
                     vary_btn, gr.Number("secondary", visible=False), gen_btn
                 ).then(
                     fn=self.run_agent,
-                    inputs=[gr.Number(True, visible=False), topic_bx, stop_after],
+                    inputs=[
+                        session,
+                        gr.Number(True, visible=False),
+                        topic_bx,
+                        stop_after,
+                    ],
                     outputs=[live],
                     show_progress=True,
+                    # Runs of all sessions share the limit, the others wait in the queue
+                    concurrency_limit=GUI_MAX_RUNS,
+                    concurrency_id="run_agent",
                 ).then(
-                    fn=updt_disp, inputs=None, outputs=sdisps
+                    fn=updt_disp, inputs=session, outputs=sdisps
                 ).then(
                     vary_btn, gr.Number("primary", visible=False), gen_btn
                 ).then(
@@ -324,10 +513,17 @@ class writer_gui:
                     vary_btn, gr.Number("secondary", visible=False), cont_btn
                 ).then(
                     fn=self.run_agent,
-                    inputs=[gr.Number(False, visible=False), topic_bx, stop_after],
+                    inputs=[
+                        session,
+                        gr.Number(False, visible=False),
+                        topic_bx,
+                        stop_after,
+                    ],
                     outputs=[live],
+                    concurrency_limit=GUI_MAX_RUNS,
+                    concurrency_id="run_agent",
                 ).then(
-                    fn=updt_disp, inputs=None, outputs=sdisps
+                    fn=updt_disp, inputs=session, outputs=sdisps
                 ).then(
                     vary_btn, gr.Number("primary", visible=False), cont_btn
                 )
@@ -339,22 +535,25 @@ class writer_gui:
                 plan = gr.Textbox(label="Plan", lines=10, interactive=True)
                 refresh_btn.click(
                     fn=self.get_state,
-                    inputs=gr.Number("plan", visible=False),
+                    inputs=[session, gr.Number("plan", visible=False)],
                     outputs=plan,
                 )
                 modify_btn.click(
                     fn=self.modify_state,
                     inputs=[
+                        session,
                         gr.Number("plan", visible=False),
                         gr.Number("planner", visible=False),
                         plan,
                     ],
                     outputs=None,
-                ).then(fn=updt_disp, inputs=None, outputs=sdisps)
+                ).then(fn=updt_disp, inputs=session, outputs=sdisps)
             with gr.Tab("Research Content"):
                 refresh_btn = gr.Button("Refresh")
                 content_bx = gr.Textbox(label="content", lines=10)
-                refresh_btn.click(fn=self.get_content, inputs=None, outputs=content_bx)
+                refresh_btn.click(
+                    fn=self.get_content, inputs=session, outputs=content_bx
+                )
             with gr.Tab("Draft"):
                 with gr.Row():
                     refresh_btn = gr.Button("Refresh")
@@ -362,18 +561,19 @@ class writer_gui:
                 draft_bx = gr.Textbox(label="draft", lines=10, interactive=True)
                 refresh_btn.click(
                     fn=self.get_state,
-                    inputs=gr.Number("draft", visible=False),
+                    inputs=[session, gr.Number("draft", visible=False)],
                     outputs=draft_bx,
                 )
                 modify_btn.click(
                     fn=self.modify_state,
                     inputs=[
+                        session,
                         gr.Number("draft", visible=False),
                         gr.Number("generate", visible=False),
                         draft_bx,
                     ],
                     outputs=None,
-                ).then(fn=updt_disp, inputs=None, outputs=sdisps)
+                ).then(fn=updt_disp, inputs=session, outputs=sdisps)
             with gr.Tab("Critique"):
                 with gr.Row():
                     refresh_btn = gr.Button("Refresh")
@@ -381,23 +581,38 @@ class writer_gui:
                 critique_bx = gr.Textbox(label="Critique", lines=10, interactive=True)
                 refresh_btn.click(
                     fn=self.get_state,
-                    inputs=gr.Number("critique", visible=False),
+                    inputs=[session, gr.Number("critique", visible=False)],
                     outputs=critique_bx,
                 )
                 modify_btn.click(
                     fn=self.modify_state,
                     inputs=[
+                        session,
                         gr.Number("critique", visible=False),
                         gr.Number("reflect", visible=False),
                         critique_bx,
                     ],
                     outputs=None,
-                ).then(fn=updt_disp, inputs=None, outputs=sdisps)
+                ).then(fn=updt_disp, inputs=session, outputs=sdisps)
             with gr.Tab("StateSnapShots"):
                 with gr.Row():
                     refresh_btn = gr.Button("Refresh")
-                snapshots = gr.Textbox(label="State Snapshots Summaries")
-                refresh_btn.click(fn=get_snapshots, inputs=None, outputs=snapshots)
+                    snapshot_page = gr.Number(
+                        value=1, minimum=1, precision=0, label="page", scale=0
+                    )
+                snapshots = gr.Textbox(label="State Snapshots Summaries", lines=20)
+                refresh_btn.click(
+                    fn=self.get_snapshots,
+                    inputs=[session, snapshot_page],
+                    outputs=snapshots,
+                )
+                snapshot_page.input(
+                    fn=self.get_snapshots,
+                    inputs=[session, snapshot_page],
+                    outputs=snapshots,
+                )
+        # Quick state lookups are not limited, agent runs are (see run_agent)
+        demo.queue(default_concurrency_limit=None, max_size=GUI_QUEUE_SIZE)
         return demo
 
     def launch(self, share=None):
@@ -0,0 +1,292 @@
+""" Lightweight tracer for the LLM calls, tool calls and graph nodes of the agent.
+
+Every span records its duration, attributes such as token usage and payload sizes,
+and the error it ended with.
+
+Modes (AGENT_TRACE environment variable):
+- off: no tracing, span() returns a shared no-op span (default)
+- jsonl: spans are appended as JSON lines to AGENT_TRACE_PATH
+- otel: spans are sent to the OpenTelemetry tracer provider set up by the application
+
+Summarize a trace file with: python tracing.py traces.jsonl
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+AGENT_TRACE = os.getenv("AGENT_TRACE", "off")
+AGENT_TRACE_PATH = os.getenv("AGENT_TRACE_PATH", "traces.jsonl")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class NoopSpan:
+    """Returned by span() when tracing is off"""
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    """A timed operation, written to the sink when it ends. Spans started while
+    another span is active (in the same thread or context) become its children."""
+
+    def __init__(self, sink, name, kind, attributes):
+        parent = _current_span.get()
+        self.sink = sink
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        self.sink.write(
+            {
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_span_id": self.parent_span_id,
+                "name": self.name,
+                "kind": self.kind,
+                "start_time": self.start_time,
+                "duration": time.perf_counter() - self.start,
+                "status": "error" if error else "ok",
+                "error": error,
+                "attributes": self.attributes,
+            }
+        )
+
+    def __enter__(self):
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self.token)
+        self.end(f"{exc_type.__name__}: {exc}" if exc_type else None)
+        return False
+
+
+class JsonlSink:
+    """Append spans to a file, one JSON object per line"""
+
+    def __init__(self, path=AGENT_TRACE_PATH):
+        self.lock = threading.Lock()
+        self.file = open(path, "a", buffering=1)
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+
+
+class OtelSpan:
+    """Span forwarded to OpenTelemetry"""
+
+    def __init__(self, tracer, name, kind, attributes):
+        self.span = tracer.start_span(name, attributes=_otel_attributes(attributes))
+        self.span.set_attribute("agent.kind", kind)
+        self.token = None
+
+    def set(self, **attributes):
+        self.span.set_attributes(_otel_attributes(attributes))
+
+    def end(self, error=None):
+        if error:
+            from opentelemetry.trace import Status, StatusCode
+
+            self.span.set_status(Status(StatusCode.ERROR, error))
+        self.span.end()
+
+    def __enter__(self):
+        from opentelemetry import context, trace
+
+        self.token = context.attach(trace.set_span_in_context(self.span))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        from opentelemetry import context
+
+        context.detach(self.token)
+        if exc is not None:
+            self.span.record_exception(exc)
+        self.end(f"{exc_type.__name__}: {exc}" if exc_type else None)
+        return False
+
+
+def _otel_attributes(attributes):
+    return {
+        key: value if isinstance(value, (str, bool, int, float)) else str(value)
+        for key, value in attributes.items()
+        if value is not None
+    }
+
+
+_sink = None
+_otel_tracer = None
+
+
+def configure(mode=AGENT_TRACE, path=AGENT_TRACE_PATH):
+    """Switch tracing to mode ("off", "jsonl" or "otel")"""
+    global _sink, _otel_tracer
+    _sink = _otel_tracer = None
+    if mode == "jsonl":
+        _sink = JsonlSink(path)
+    elif mode == "otel":
+        from opentelemetry import trace
+
+        _otel_tracer = trace.get_tracer("agent")
+    elif mode != "off":
+        raise ValueError(f"Unknown trace mode: {mode}")
+
+
+def enabled():
+    return _sink is not None or _otel_tracer is not None
+
+
+def span(name, kind="internal", **attributes):
+    """Start a span. Use it as a context manager, or call end() on it."""
+    if _sink is not None:
+        return Span(_sink, name, kind, attributes)
+    if _otel_tracer is not None:
+        return OtelSpan(_otel_tracer, name, kind, attributes)
+    return NOOP_SPAN
+
+
+def traced(name, kind="internal"):
+    """Decorator running the function (or coroutine function) in a span, with the
+    size of its text arguments and result"""
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not enabled():
+                    return await fn(*args, **kwargs)
+                with span(name, kind, input_chars=_text_size(args)) as s:
+                    result = await fn(*args, **kwargs)
+                    s.set(output_chars=_text_size([result]))
+                    return result
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return fn(*args, **kwargs)
+            with span(name, kind, input_chars=_text_size(args)) as s:
+                result = fn(*args, **kwargs)
+                s.set(output_chars=_text_size([result]))
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def _text_size(values):
+    return sum(len(value) for value in values if isinstance(value, (str, bytes)))
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """LangChain callback handler recording a span for every chat model call"""
+
+    def __init__(self):
+        self.spans = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        params = kwargs.get("invocation_params") or {}
+        self.spans[run_id] = span(
+            "llm.chat",
+            "llm",
+            model=params.get("model_name") or params.get("model"),
+            messages=sum(len(batch) for batch in messages),
+            input_chars=sum(len(str(m.content)) for batch in messages for m in batch),
+        )
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        llm_span = self.spans.pop(run_id, None)
+        if llm_span is None:
+            return
+        generation = response.generations[0][0] if response.generations else None
+        message = getattr(generation, "message", None)
+        usage = getattr(message, "usage_metadata", None) or {}
+        llm_span.set(
+            prompt_tokens=usage.get("input_tokens"),
+            completion_tokens=usage.get("output_tokens"),
+            output_chars=len(generation.text) if generation else 0,
+        )
+        llm_span.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        llm_span = self.spans.pop(run_id, None)
+        if llm_span is not None:
+            llm_span.end(f"{type(error).__name__}: {error}")
+
+
+def callbacks():
+    """Callbacks to pass to a LangChain model, None when tracing is off"""
+    return [TracingCallbackHandler()] if enabled() else None
+
+
+def summarize(path):
+    """Print the count, errors, total and percentile durations of each span name"""
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    tokens = defaultdict(int)
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            name = record["name"]
+            durations[name].append(record["duration"])
+            errors[name] += record["status"] == "error"
+            tokens[name] += (record["attributes"].get("prompt_tokens") or 0) + (
+                record["attributes"].get("completion_tokens") or 0
+            )
+    print(
+        f"{'span':<32} {'count':>6} {'errors':>6} {'total s':>9} "
+        f"{'p50 s':>8} {'p95 s':>8} {'tokens':>9}"
+    )
+    for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        p50 = values[len(values) // 2]
+        p95 = values[min(int(len(values) * 0.95), len(values) - 1)]
+        print(
+            f"{name:<32} {len(values):>6} {errors[name]:>6} {sum(values):>9.3f} "
+            f"{p50:>8.3f} {p95:>8.3f} {tokens[name]:>9}"
+        )
+
+
+configure()
+
+
+if __name__ == "__main__":
+    summarize(sys.argv[1] if len(sys.argv) > 1 else AGENT_TRACE_PATH)
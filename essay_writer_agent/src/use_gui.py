@@ -7,5 +7,5 @@ from gui import writer_gui
 
 # Use the GUI
 MultiAgent = ewriter()
-app = writer_gui(MultiAgent.graph)
+app = writer_gui(MultiAgent.graph, content_store=MultiAgent.content_store)
 app.launch()
@@ -0,0 +1,81 @@
+""" Check that the modules shared by the LangGraph agents are the same in each agent.
+
+company_research_tool and essay_writer_agent import their modules by name from
+their own src directory, so the modules they share are copied in both. Edit one
+copy, then run this check, or copy it over the other with --copy-from.
+
+Usage (from the repository root):
+    python tools/check_shared_modules.py
+    python tools/check_shared_modules.py --copy-from company_research_tool
+"""
+
+import argparse
+import difflib
+import shutil
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+AGENTS = ["company_research_tool", "essay_writer_agent"]
+SHARED_MODULES = [
+    "checkpointer.py",
+    "content_pipeline.py",
+    "content_store.py",
+    "llm_cache.py",
+    "tavily_cache.py",
+    "tracing.py",
+]
+
+
+def module_path(agent, module):
+    return ROOT / agent / "src" / module
+
+
+def differences(reference=AGENTS[0]):
+    """Unified diffs of the copies that differ from the reference agent's"""
+    diffs = []
+    for module in SHARED_MODULES:
+        expected = module_path(reference, module)
+        for agent in AGENTS:
+            path = module_path(agent, module)
+            if agent == reference or path.read_bytes() == expected.read_bytes():
+                continue
+            diffs.append(
+                "".join(
+                    difflib.unified_diff(
+                        expected.read_text().splitlines(keepends=True),
+                        path.read_text().splitlines(keepends=True),
+                        str(expected.relative_to(ROOT)),
+                        str(path.relative_to(ROOT)),
+                    )
+                )
+            )
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--copy-from",
+        choices=AGENTS,
+        help="overwrite the other agents' copies with this agent's",
+    )
+    args = parser.parse_args()
+    if args.copy_from:
+        for module in SHARED_MODULES:
+            for agent in AGENTS:
+                if agent != args.copy_from:
+                    shutil.copyfile(
+                        module_path(args.copy_from, module), module_path(agent, module)
+                    )
+    diffs = differences()
+    for diff in diffs:
+        print(diff)
+    if diffs:
+        print(f"{len(diffs)} shared modules differ between {', '.join(AGENTS)}")
+        sys.exit(1)
+    print(f"{len(SHARED_MODULES)} shared modules are the same in {', '.join(AGENTS)}")
+
+
+if __name__ == "__main__":
+    main()